@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from media import MediaStore
+
+FIELD_SEPARATOR = "\x1f"
+# Fields in the order format_card returns them
+FIELD_NAMES = ["Front", "Back", "Image"]
+CARD_CSS = (
+    ".card { font-family: arial; font-size: 24px; text-align: center; "
+    "color: black; background-color: white; }\nimg { max-width: 100%; }"
+)
+FRONT_TEMPLATE = "{{Front}}<br>{{Image}}"
+BACK_TEMPLATE = "{{FrontSide}}<hr id=answer>{{Back}}"
+
+SCHEMA = """
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null,
+    scm integer not null, ver integer not null, dty integer not null,
+    usn integer not null, ls integer not null, conf text not null,
+    models text not null, decks text not null, dconf text not null,
+    tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null,
+    mod integer not null, usn integer not null, tags text not null,
+    flds text not null, sfld integer not null, csum integer not null,
+    flags integer not null, data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null,
+    ord integer not null, mod integer not null, usn integer not null,
+    type integer not null, queue integer not null, due integer not null,
+    ivl integer not null, factor integer not null, reps integer not null,
+    lapses integer not null, left integer not null, odue integer not null,
+    odid integer not null, flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null,
+    ease integer not null, ivl integer not null, lastIvl integer not null,
+    factor integer not null, time integer not null, type integer not null
+);
+CREATE TABLE graves (
+    usn integer not null, oid integer not null, type integer not null
+);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+"""
+
+
+def stable_id(name: str) -> int:
+    """Same name, same ID, so importing a deck again updates it"""
+    return (1 << 30) + int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:7], 16)
+
+
+def strip_html(text: str) -> str:
+    return re.sub(r"<[^>]*>", "", text).strip()
+
+
+def field_checksum(text: str) -> int:
+    return int(hashlib.sha1(strip_html(text).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def _collection_json(deck_id: int, deck_name: str, model_id: int, now: int) -> tuple:
+    model = {
+        "id": model_id,
+        "name": "Clanki",
+        "type": 0,
+        "mod": now,
+        "usn": -1,
+        "sortf": 0,
+        "did": deck_id,
+        "tmpls": [
+            {
+                "name": "Card 1",
+                "ord": 0,
+                "qfmt": FRONT_TEMPLATE,
+                "afmt": BACK_TEMPLATE,
+                "did": None,
+                "bqfmt": "",
+                "bafmt": "",
+            }
+        ],
+        "flds": [
+            {
+                "name": name,
+                "ord": i,
+                "sticky": False,
+                "rtl": False,
+                "font": "Arial",
+                "size": 20,
+                "media": [],
+            }
+            for i, name in enumerate(FIELD_NAMES)
+        ],
+        "css": CARD_CSS,
+        "latexPre": "",
+        "latexPost": "",
+        "latexsvg": False,
+        "req": [[0, "any", [0]]],
+        "tags": [],
+        "vers": [],
+    }
+    deck = {
+        "lrnToday": [0, 0],
+        "revToday": [0, 0],
+        "newToday": [0, 0],
+        "timeToday": [0, 0],
+        "collapsed": False,
+        "browserCollapsed": False,
+        "desc": "",
+        "dyn": 0,
+        "conf": 1,
+        "extendNew": 10,
+        "extendRev": 50,
+        "usn": -1,
+        "mod": now,
+    }
+    decks = {
+        "1": {**deck, "id": 1, "name": "Default"},
+        str(deck_id): {**deck, "id": deck_id, "name": deck_name},
+    }
+    dconf = {
+        "1": {
+            "id": 1,
+            "name": "Default",
+            "mod": 0,
+            "usn": 0,
+            "maxTaken": 60,
+            "autoplay": True,
+            "timer": 0,
+            "replayq": True,
+            "dyn": False,
+            "new": {
+                "delays": [1, 10],
+                "ints": [1, 4, 7],
+                "initialFactor": 2500,
+                "order": 1,
+                "perDay": 20,
+                "bury": True,
+                "separate": True,
+            },
+            "rev": {
+                "perDay": 200,
+                "ease4": 1.3,
+                "fuzz": 0.05,
+                "maxIvl": 36500,
+                "ivlFct": 1,
+                "bury": True,
+                "minSpace": 1,
+            },
+            "lapse": {
+                "delays": [10],
+                "mult": 0,
+                "minInt": 1,
+                "leechFails": 8,
+                "leechAction": 0,
+            },
+        }
+    }
+    conf = {
+        "activeDecks": [1],
+        "curDeck": 1,
+        "newSpread": 0,
+        "collapseTime": 1200,
+        "timeLim": 0,
+        "estTimes": True,
+        "dueCounts": True,
+        "curModel": str(model_id),
+        "nextPos": 1,
+        "sortType": "noteFld",
+        "sortBackwards": False,
+        "addToCur": True,
+    }
+    return (
+        json.dumps(conf),
+        json.dumps({str(model_id): model}),
+        json.dumps(decks),
+        json.dumps(dconf),
+    )
+
+
+class ApkgWriter:
+    """Builds an Anki package (.apkg) straight from the finished cards.
+
+    Cards are buffered as they're written and inserted in bulk on each
+    `flush`, all inside one transaction committed by `close`. close() then
+    streams the collection and every referenced media file from disk into
+    the zip, so neither has to fit in memory.
+    """
+
+    def __init__(self, path: str, deck_name: str, media: MediaStore | None = None):
+        self.path = path
+        self.deck_name = deck_name
+        self.media = media
+        self.count = 0
+        self._deck_id = stable_id(f"deck:{deck_name}")
+        self._model_id = stable_id("model:clanki")
+        self._now = int(time.time())
+        self._id_base = int(time.time() * 1000)
+        self._pending = []
+        self._media_files = {}
+        self._seen = {}
+        self._tmp = tempfile.TemporaryDirectory(prefix="clanki-apkg-")
+        self._db_path = os.path.join(self._tmp.name, "collection.anki2")
+
+        self._conn = sqlite3.connect(self._db_path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.executescript(SCHEMA)
+        self._conn.execute("BEGIN")
+        self._conn.execute(
+            "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+            (
+                self._now // 86400 * 86400,
+                self._now * 1000,
+                self._now * 1000,
+                *_collection_json(
+                    self._deck_id, deck_name, self._model_id, self._now
+                ),
+            ),
+        )
+
+    def write(self, card: list, media: str | None = None) -> None:
+        self._pending.append(card)
+        if media and self.media is not None and self.media.has(media):
+            self._media_files.setdefault(media, self.media.file_path(media))
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+
+        notes = []
+        cards = []
+        for card in self._pending:
+            note_id = self._id_base + self.count
+            # Keyed on the phrase so a re-import updates the note, repeats of a
+            # phrase are numbered so each still gets its own
+            repeat = self._seen.get(card[1], 0)
+            self._seen[card[1]] = repeat + 1
+            guid = hashlib.sha1(
+                f"{self.deck_name}\x1f{card[1]}\x1f{repeat}".encode("utf-8")
+            ).hexdigest()[:16]
+            notes.append(
+                (
+                    note_id,
+                    guid,
+                    self._model_id,
+                    self._now,
+                    -1,
+                    "",
+                    FIELD_SEPARATOR.join(card),
+                    strip_html(card[0]),
+                    field_checksum(card[0]),
+                    0,
+                    "",
+                )
+            )
+            # A new card: type and queue 0, due in input order, no scheduling yet
+            due = self.count + 1
+            cards.append(
+                (note_id, note_id, self._deck_id, 0, self._now, -1, 0, 0, due)
+                + (0,) * 8
+                + ("",)
+            )
+            self.count += 1
+
+        self._conn.executemany(
+            "INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", notes
+        )
+        self._conn.executemany(
+            "INSERT INTO cards VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            cards,
+        )
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.execute("COMMIT")
+        self._conn.close()
+
+        media_map = {}
+        tmp_path = f"{self.path}.tmp"
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.write(self._db_path, "collection.anki2")
+            for i, (name, file_path) in enumerate(self._media_files.items()):
+                # Images are already compressed, deflating them again is wasted work
+                zf.write(file_path, str(i), compress_type=zipfile.ZIP_STORED)
+                media_map[str(i)] = name
+            zf.writestr("media", json.dumps(media_map))
+        os.replace(tmp_path, self.path)
+        self._tmp.cleanup()
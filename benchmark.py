@@ -0,0 +1,350 @@
+"""Offline benchmark for the card pipeline.
+
+Starts the stub server from stub_server.py and runs decks of each size
+through the pipeline in a fresh subprocess, so every size gets its own
+cache and its own peak memory figure. Reports wall time, per-stage
+throughput and p50/p95 latency, bytes served per route and peak RSS.
+--startup instead times how long fresh interpreters take to import run.py
+and web.py.
+
+    python3 benchmark.py --sizes 10,100,1000 --latency claude=0.5 --json now.json
+    python3 benchmark.py --baseline now.json
+    python3 benchmark.py --startup
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from stub_server import (
+    FIXTURES_DIR,
+    ROUTES,
+    StubState,
+    start_stub_server,
+    stop_stub_server,
+    stub_env,
+)
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+# Mean seconds added per request, roughly what the real services take
+DEFAULT_LATENCY = {"brave": 0.15, "images": 0.05, "translate": 0.3, "claude": 1.0}
+# The stub doesn't enforce quotas, so don't let the client-side limiter either
+UNTHROTTLED_ENV = {"CLANKI_BRAVE_RPS": "100000", "CLANKI_CLAUDE_RPM": "6000000"}
+# A bare interpreter is timed too, so the entry points can be read against it
+STARTUP_TARGETS = {"python": "pass", "run": "import run", "web": "import web"}
+HEAVY_MODULES = ("anthropic", "PIL", "deep_translator", "bs4", "filetype", "flask")
+STARTUP_REPEAT = 5
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def make_phrases(count: int) -> list:
+    """`count` distinct phrases, the recorded ones numbered once they run out"""
+    with open(os.path.join(FIXTURES_DIR, "phrases.txt"), encoding="utf-8") as f:
+        base = [line.strip() for line in f if line.strip()]
+    return [
+        base[i % len(base)] + (f" {i // len(base) + 1}" if i >= len(base) else "")
+        for i in range(count)
+    ]
+
+
+def parse_routes(text: str, defaults: dict) -> dict:
+    values = dict(defaults)
+    for part in filter(None, (text or "").split(",")):
+        route, _, value = part.partition("=")
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route {route}")
+        values[route] = float(value)
+    return values
+
+
+def timed_stages(stages: list, timings: dict) -> list:
+    """Wrap each stage's fn to record how long every call took and for how many items"""
+    from scheduler import Stage
+
+    lock = threading.Lock()
+
+    def wrap(stage):
+        record = timings.setdefault(
+            stage.name, {"calls": [], "items": 0, "first": None, "last": None}
+        )
+
+        def fn(value):
+            start = time.perf_counter()
+            try:
+                return stage.fn(value)
+            finally:
+                end = time.perf_counter()
+                with lock:
+                    record["calls"].append(end - start)
+                    record["items"] += len(value) if stage.batch_size > 1 else 1
+                    record["first"] = min(record["first"] or start, start)
+                    record["last"] = max(record["last"] or end, end)
+
+        return Stage(stage.name, fn, stage.workers, stage.batch_size)
+
+    return [wrap(stage) for stage in stages]
+
+
+def run_worker(args) -> None:
+    """Build one deck in this process and print its measurements as JSON"""
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    from cache import ResultCache
+    from config import RunConfig
+    from deck_files import CardWriter, format_card
+    from dedupe import run_deduplicated
+    from metrics import metrics
+    from pipeline import build_stages
+
+    phrases = make_phrases(args.worker)
+    config = RunConfig(
+        use_ai=args.ai != "false",
+        use_thumbnails=args.thumbnails,
+        use_batch=args.batch,
+        cache=ResultCache(enabled=not args.no_cache),
+    )
+    timings = {}
+    stages = timed_stages(build_stages(config), timings)
+
+    start = time.perf_counter()
+    rows = run_deduplicated(phrases, stages)
+    with open(os.devnull, "w", encoding="utf-8") as sink:
+        writer = CardWriter(sink)
+        for phrase, row in zip(phrases, rows):
+            writer.write(format_card(phrase, row["translation"], row["image"]))
+    wall = time.perf_counter() - start
+
+    result = {
+        "phrases": len(phrases),
+        "wall": wall,
+        "start_rss_kb": start_rss,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": {
+            name: {
+                "calls": len(record["calls"]),
+                "items": record["items"],
+                "throughput": record["items"]
+                / max(record["last"] - record["first"], 1e-9),
+                "p50_ms": percentile(record["calls"], 50) * 1000,
+                "p95_ms": percentile(record["calls"], 95) * 1000,
+            }
+            for name, record in timings.items()
+        },
+        # Provider timings, token usage and cache hits, as run.py --metrics writes them
+        "metrics": metrics.snapshot(),
+    }
+    sys.stdout.write("BENCHMARK " + json.dumps(result) + "\n")
+
+
+def run_size(size: int, state: StubState, env: dict, args) -> dict:
+    state.reset()
+    passthrough = ["--ai", args.ai] + (["--thumbnails"] if args.thumbnails else [])
+    passthrough += ["--batch"] if args.batch else []
+    passthrough += ["--no-cache"] if args.no_cache else []
+    with tempfile.TemporaryDirectory(prefix="clanki-bench-") as cache_dir:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--worker", str(size), *passthrough],
+            env={**os.environ, **env, "CLANKI_CACHE_DIR": cache_dir},
+            capture_output=True,
+            text=True,
+        )
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("BENCHMARK ")]
+    if proc.returncode != 0 or not lines:
+        sys.stderr.write(proc.stdout[-2000:] + proc.stderr[-4000:])
+        raise RuntimeError(f"benchmark run for {size} phrases failed")
+
+    result = json.loads(lines[-1].removeprefix("BENCHMARK "))
+    result["routes"] = {route: dict(stats) for route, stats in state.stats.items()}
+    return result
+
+
+def delta(now: float, then: float | None, higher_is_better: bool) -> str:
+    if not then:
+        return ""
+    change = (now - then) / then * 100
+    if abs(change) < 1:
+        return f" ({change:+.0f}%)"
+    better = change > 0 if higher_is_better else change < 0
+    return f" ({change:+.0f}% {'better' if better else 'worse'})"
+
+
+def measure_startup(repeat: int) -> dict:
+    """Seconds for a fresh interpreter to import each entry point, best and median"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, code in STARTUP_TARGETS.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+            times.append(time.perf_counter() - start)
+
+        # Heavy libraries that came in with the import and so slow every start
+        probe = f"import sys; {code}; print(','.join(m for m in {HEAVY_MODULES!r} "
+        probe += "if m in sys.modules))"
+        loaded = subprocess.run(
+            [sys.executable, "-c", probe],
+            cwd=here,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "loaded": [m for m in loaded.split(",") if m],
+        }
+    return results
+
+
+def report_startup(result: dict, baseline: dict | None = None) -> None:
+    base = baseline or {}
+    sys.stdout.write(f"\n  {'startup':<10}{'min ms':>10}{'median ms':>12}  loaded\n")
+    for name, timing in result.items():
+        then = base.get(name, {}).get("median")
+        sys.stdout.write(
+            f"  {name:<10}{timing['min'] * 1000:>10.0f}"
+            f"{timing['median'] * 1000:>12.0f}  {', '.join(timing['loaded']) or '-'}"
+            f"{delta(timing['median'], then, False)}\n"
+        )
+
+
+def report(result: dict, baseline: dict | None = None) -> None:
+    base = baseline or {}
+    peak_mb = result["peak_rss_kb"] / 1024
+    sys.stdout.write(
+        f"\n{result['phrases']} phrases: {result['wall']:.2f}s"
+        f"{delta(result['wall'], base.get('wall'), False)}, "
+        f"{result['phrases'] / result['wall']:.1f} cards/s, peak RSS {peak_mb:.0f} MB"
+        f"{delta(peak_mb, base.get('peak_rss_kb', 0) / 1024, False)}\n"
+    )
+    sys.stdout.write(
+        f"  {'stage':<10}{'calls':>8}{'items':>8}"
+        f"{'items/s':>10}{'p50 ms':>10}{'p95 ms':>10}\n"
+    )
+    for name, stage in result["stages"].items():
+        then = base.get("stages", {}).get(name, {})
+        sys.stdout.write(
+            f"  {name:<10}{stage['calls']:>8}{stage['items']:>8}"
+            f"{stage['throughput']:>10.1f}"
+            f"{stage['p50_ms']:>10.1f}{stage['p95_ms']:>10.1f}"
+            f"{delta(stage['throughput'], then.get('throughput'), True)}\n"
+        )
+    sys.stdout.write(f"  {'route':<10}{'requests':>10}{'errors':>8}{'MB':>10}\n")
+    for route, stats in result["routes"].items():
+        sys.stdout.write(
+            f"  {route:<10}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{stats['bytes'] / 1e6:>10.2f}\n"
+        )
+
+
+def handle_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the card pipeline offline")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma separated deck sizes to run (default 10,100,1000,10000)",
+    )
+    parser.add_argument(
+        "--latency",
+        default="",
+        help="mean seconds added per request, e.g. brave=0.2,claude=1.5",
+    )
+    parser.add_argument(
+        "--error-rate",
+        default="",
+        help="fraction of requests that fail per route, e.g. images=0.05",
+    )
+    parser.add_argument("--ai", choices=["true", "false"], default="true")
+    parser.add_argument("--thumbnails", action="store_true")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="classify and judge through the Message Batches API",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="run without the result cache"
+    )
+    parser.add_argument(
+        "--quotas",
+        action="store_true",
+        help="keep the client-side rate limits instead of lifting them",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="time how long run.py and web.py take to import instead of building decks",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=STARTUP_REPEAT,
+        help=f"fresh interpreters started per entry point (default {STARTUP_REPEAT})",
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = handle_cli()
+    if args.worker is not None:
+        run_worker(args)
+        return
+
+    if args.startup:
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f).get("startup", {})
+        startup = measure_startup(args.repeat)
+        report_startup(startup, baseline)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"startup": startup}, f, indent=2)
+        return
+
+    state = StubState(
+        latency=parse_routes(args.latency, DEFAULT_LATENCY),
+        error_rate=parse_routes(args.error_rate, {}),
+        seed=args.seed,
+    )
+    servers = start_stub_server(state)
+    env = stub_env(servers[0]) | ({} if args.quotas else UNTHROTTLED_ENV)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            results = json.load(f).get("results", [])
+            baseline = {str(r["phrases"]): r for r in results}
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        result = run_size(size, state, env, args)
+        results.append(result)
+        report(result, baseline.get(str(size)))
+
+    stop_stub_server(servers)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            settings = {"latency": state.latency, "error_rate": state.error_rate}
+            json.dump({**settings, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+
+CACHE_DIR = os.getenv(
+    "CLANKI_CACHE_DIR", os.path.join(pathlib.Path.home(), ".cache", "clanki")
+)
+DEFAULT_TTL = 30 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Size is only checked every so often, summing the table on every write is wasteful
+EVICT_EVERY = 200
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_key(namespace: str, *parts) -> str:
+    """Content address for a result, e.g. cache_key("translate", "it", "en", phrase)"""
+    payload = json.dumps([namespace, *parts], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """SQLite-backed store for translations, queries, search results and scores.
+
+    With `enabled` off nothing is read or written. With `refresh` on every
+    lookup misses but fresh results are still stored.
+    """
+
+    def __init__(
+        self,
+        path: str = os.path.join(CACHE_DIR, "results.sqlite3"),
+        ttl: int = DEFAULT_TTL,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        enabled: bool = True,
+        refresh: bool = False,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )"""
+            )
+        return self._conn
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        if self.refresh:
+            metrics.inc("clanki_cache_lookups_total", result="miss")
+            return None
+
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                metrics.inc("clanki_cache_lookups_total", result="miss")
+                return None
+
+            value, created = row
+            if now - created > self.ttl:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                metrics.inc("clanki_cache_lookups_total", result="miss")
+                return None
+
+            conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+
+        metrics.inc("clanki_cache_lookups_total", result="hit")
+        return json.loads(value)
+
+    def set(self, key: str, value) -> None:
+        if not self.enabled:
+            return
+
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used rows until we're comfortably under the limit
+        excess = total - int(self.max_bytes * 0.9)
+        freed = 0
+        stale = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM results ORDER BY accessed ASC"
+        ):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM results WHERE key = ?", stale)
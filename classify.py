@@ -0,0 +1,156 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import LLMClient
+from prompts import phrase_prompt
+
+# Rough budget of phrase tokens per request, keeps the reply well inside max_tokens
+CHUNK_INPUT_TOKENS = 1500
+CHUNK_MAX_PHRASES = 100
+CHUNK_WORKERS = 4
+CHUNK_RETRIES = 2
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def chunk_by_tokens(
+    phrases: list,
+    token_budget: int = CHUNK_INPUT_TOKENS,
+    max_phrases: int = CHUNK_MAX_PHRASES,
+) -> list:
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    for phrase in phrases:
+        tokens = estimate_tokens(phrase)
+        if current and (
+            current_tokens + tokens > token_budget or len(current) >= max_phrases
+        ):
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+
+        current.append(phrase)
+        current_tokens += tokens
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def _reply_budget(chunk: list) -> int:
+    # A query is usually a few words, allow double the phrase plus quoting
+    return min(8192, 64 + sum(2 * estimate_tokens(p) + 8 for p in chunk))
+
+
+def _chunk_request(chunk: list, source_language: str, model: str) -> dict:
+    prompt = phrase_prompt.replace("{text}", json.dumps(chunk, ensure_ascii=False))
+    prompt = prompt.replace("{source_language}", source_language)
+    return {
+        "model": model,
+        "max_tokens": _reply_budget(chunk),
+        "system": "you are a phrase classifier",
+        "messages": [{"role": "user", "content": prompt}],
+    }
+
+
+def _parse_reply(chunk: list, message) -> list | None:
+    try:
+        queries = json.loads(message.content[0].text)
+    except json.JSONDecodeError as e:
+        print("Search queries weren't valid JSON", e)
+        return None
+
+    if isinstance(queries, list) and len(queries) == len(chunk):
+        return queries
+
+    print(
+        f"Expected {len(chunk)} search queries, got "
+        f"{len(queries) if isinstance(queries, list) else 'none'}"
+    )
+    return None
+
+
+def _classify_chunk(chunk: list, source_language: str, model: str) -> list | None:
+    import anthropic
+
+    request = _chunk_request(chunk, source_language, model)
+
+    for attempt in range(CHUNK_RETRIES + 1):
+        try:
+            message = LLMClient().fetch(
+                request["model"],
+                request["max_tokens"],
+                request["system"],
+                request["messages"],
+            )
+        except anthropic.APIConnectionError as e:
+            print("The server could not be reached", e)
+            continue
+        except anthropic.RateLimitError:
+            print("A 429 status code was received; we should back off a bit.")
+            continue
+        except anthropic.APIStatusError as e:
+            print("Another issues occurred: ", e)
+            continue
+
+        queries = _parse_reply(chunk, message)
+        if queries is not None:
+            return queries
+
+    return None
+
+
+def _classify_chunks_in_batch(
+    chunks: list, source_language: str, model: str
+) -> list:
+    results = [None] * len(chunks)
+    pending = list(range(len(chunks)))
+
+    # Each round resubmits only the chunks that failed in the last one
+    for attempt in range(CHUNK_RETRIES + 1):
+        messages = LLMClient().batch(
+            {
+                f"classify-{i}": _chunk_request(chunks[i], source_language, model)
+                for i in pending
+            }
+        )
+        for i in pending:
+            message = messages.get(f"classify-{i}")
+            if message is not None:
+                results[i] = _parse_reply(chunks[i], message)
+
+        pending = [i for i in pending if results[i] is None]
+        if not pending:
+            break
+
+    return results
+
+
+def classify_in_chunks(
+    phrases: list, source_language: str, model: str, use_batch: bool = False
+) -> list | None:
+    """Generate a search query per phrase, a token-budgeted chunk per request.
+
+    Chunks are sent concurrently, or all together through the Message Batches
+    API with `use_batch`. A chunk whose reply is malformed or the wrong length
+    is retried on its own. Returns None if any chunk still fails.
+    """
+    chunks = chunk_by_tokens(phrases)
+    if use_batch:
+        results = _classify_chunks_in_batch(chunks, source_language, model)
+    else:
+        with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as pool:
+            results = list(
+                pool.map(lambda c: _classify_chunk(c, source_language, model), chunks)
+            )
+
+    if any(result is None for result in results):
+        return None
+
+    return [query for result in results for query in result]
@@ -0,0 +1,36 @@
+from dataclasses import dataclass, field
+
+from cache import ResultCache
+from images import JUDGE_JPEG_QUALITY, JUDGE_MAX_EDGE
+from media import MediaStore
+from scheduler import DEFAULT_WORKERS
+
+DEFAULT_MODEL = "claude-sonnet-4-20250514"
+
+
+@dataclass(frozen=True)
+class RunConfig:
+    """Settings for one deck build, passed through every stage of the pipeline.
+
+    Nothing here is global, so runs with different settings can share a
+    process.
+    """
+
+    use_ai: bool = True
+    use_thumbnails: bool = False
+    use_batch: bool = False
+    # Give rows whose phrases share a search query different images
+    distinct_images: bool = False
+    source_language: str = "it"
+    target_language: str = "en"
+    # How the source language is named in the search query prompt
+    source_language_name: str = "italian"
+    model: str = DEFAULT_MODEL
+    candidate_count: int = 20
+    # How candidates are shrunk before Claude sees them
+    judge_max_edge: int = JUDGE_MAX_EDGE
+    judge_jpeg_quality: int = JUDGE_JPEG_QUALITY
+    workers: dict = field(default_factory=lambda: dict(DEFAULT_WORKERS))
+    cache: ResultCache = field(default_factory=ResultCache)
+    # Where card images are saved, cards link to the remote URL when unset
+    media: MediaStore | None = None
@@ -0,0 +1,72 @@
+import csv
+import itertools
+from typing import Iterable, Iterator
+
+# Phrases pushed through the pipeline at a time, bounds memory on huge files
+STREAM_WINDOW = 1000
+FLUSH_EVERY = 100
+
+
+def iter_phrases(lines: Iterable[str], extension: str) -> Iterator[str]:
+    """Phrases from the lines of a .txt or .csv file, read one at a time.
+
+    Blank lines are skipped. Raises ValueError for an unsupported file type
+    or a CSV row with more than one column.
+    """
+    if extension == ".txt":
+        for line in lines:
+            phrase = line.strip()
+            if phrase:
+                yield phrase
+
+    elif extension == ".csv":
+        for row in csv.reader(lines):
+            if len(row) > 1:
+                raise ValueError(
+                    "CSV files should only have one column containing phrases, "
+                    "delete any additional columns"
+                )
+            if row and row[0].strip():
+                yield row[0].strip()
+
+    else:
+        raise ValueError("File type must be '.txt' or '.csv'")
+
+
+def windows(items: Iterable, size: int = STREAM_WINDOW) -> Iterator[list]:
+    iterator = iter(items)
+    while window := list(itertools.islice(iterator, size)):
+        yield window
+
+
+def format_card(original_phrase: str, translated_phrase: str, image: dict) -> list:
+    # A stored image is referenced by its name in Anki's media folder
+    src = image.get("media") or image.get("url")
+    return [
+        translated_phrase,
+        original_phrase,
+        f"""<img src='{src}'/>""" if src else "",
+    ]
+
+
+class CardWriter:
+    """Writes cards to a CSV file as they're ready, flushing every `flush_every` rows"""
+
+    def __init__(self, file, flush_every: int = FLUSH_EVERY):
+        self.file = file
+        self.flush_every = flush_every
+        self.count = 0
+        self._writer = csv.writer(file)
+
+    def write(self, card: list, media: str | None = None) -> None:
+        # A CSV can only name the media file, importing it is left to Anki
+        self._writer.writerow(card)
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
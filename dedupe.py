@@ -0,0 +1,124 @@
+import sys
+import threading
+from concurrent.futures import Future
+
+from scheduler import run_pipeline
+
+
+def normalize_phrase(phrase: str) -> str:
+    return " ".join(phrase.split()).casefold()
+
+
+def group_phrases(phrases: list) -> tuple[list, list]:
+    """Collapse phrases that only differ in case or spacing.
+
+    Returns the distinct phrases, first spelling wins, and for each one the
+    indexes of the input phrases it stands for.
+    """
+    positions = {}
+    unique = []
+    groups = []
+
+    for i, phrase in enumerate(phrases):
+        key = normalize_phrase(phrase)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(phrase)
+            groups.append([])
+        groups[positions[key]].append(i)
+
+    return unique, groups
+
+
+def run_deduplicated(
+    phrases: list, stages: list, on_result=None, on_stage=None, cancel=None
+) -> list:
+    """run_pipeline over each distinct phrase once, fanning rows out to every input.
+
+    Rows and callbacks use the input indexes, each copy keeping its own
+    spelling of the phrase.
+    """
+    unique, groups = group_phrases(phrases)
+    if len(unique) < len(phrases):
+        sys.stdout.write(f"Merged {len(phrases) - len(unique)} repeated phrases\n")
+
+    def fan_out(index: int, row: dict) -> list:
+        return [(i, {**row, "phrase": phrases[i]}) for i in groups[index]]
+
+    def stage_done(stage: str, index: int, row: dict) -> None:
+        for i, copy in fan_out(index, row):
+            on_stage(stage, i, copy)
+
+    def row_done(index: int, row: dict) -> None:
+        for i, copy in fan_out(index, row):
+            on_result(i, copy)
+
+    rows = run_pipeline(
+        [{"phrase": phrase} for phrase in unique],
+        stages,
+        row_done if on_result else None,
+        stage_done if on_stage else None,
+        cancel,
+    )
+
+    output = [None] * len(phrases)
+    for index, row in enumerate(rows):
+        for i, copy in fan_out(index, row):
+            output[i] = copy
+    return output
+
+
+class SingleFlight:
+    """Runs the work for a key once per run, callers with the same key share it.
+
+    A caller that arrives while the work is in flight waits for it rather
+    than starting its own. Errors are shared the same way.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, compute):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
+class UsedImages:
+    """Images already handed to rows sharing a query, so later rows can pick others"""
+
+    def __init__(self):
+        self._used = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def add(self, key: str, url: str) -> None:
+        with self._lock:
+            self._used.setdefault(key, set()).add(url)
+
+    def exclude(self, key: str, data: dict) -> dict:
+        """Search results minus the images already used, or all if none are left"""
+        with self._lock:
+            used = set(self._used.get(key, ()))
+
+        results = [
+            r
+            for r in data.get("results")
+            if r.get("properties", {}).get("url") not in used
+        ]
+        return {**data, "results": results} if results else data
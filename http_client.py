@@ -0,0 +1,60 @@
+import threading
+
+import certifi
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Distinct hosts kept pooled, image candidates come from lots of different sites
+POOL_CONNECTIONS = 64
+# Connections kept open per host, matches the image fetch pool
+POOL_MAXSIZE = 16
+DEFAULT_TIMEOUT = (3.05, 10)
+# 429s and 503s are left to the rate limiter, they need backing off rather than
+# a quick retry, and retrying them here too would multiply the attempts
+RETRY_POLICY = Retry(
+    total=2,
+    connect=2,
+    read=1,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 504),
+    allowed_methods=frozenset(["GET", "HEAD"]),
+    raise_on_status=False,
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """A requests.Session that applies DEFAULT_TIMEOUT unless a call sets one"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+def build_session() -> requests.Session:
+    session = PooledSession()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=RETRY_POLICY,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Read the CA bundle path once rather than on every call
+    session.verify = certifi.where()
+    session.headers.update(
+        {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+    )
+    return session
+
+
+def get_session() -> requests.Session:
+    """The process-wide session, connections are reused across threads and runs"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session()
+        return _session
@@ -0,0 +1,215 @@
+import base64
+import io
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from http_client import get_session
+from metrics import metrics
+from prefilter import JUDGE_LIMIT, average_hash, prune_candidates
+from validate_b64 import detected_mime_from_bytes
+
+# Pillow is imported when the first image is resized, --ai false runs never need it
+if TYPE_CHECKING:
+    from PIL import Image
+
+MIME_TYPES = ["image/jpeg", "image/png", "image/webp"]
+
+# Global cap on in-flight image downloads, shared by every phrase
+MAX_FETCH_WORKERS = 16
+MAX_FETCHES_PER_HOST = 4
+# (connect, read) seconds, so one slow host can't hold up a whole phrase
+FETCH_TIMEOUT = (3.05, 10)
+# Images are only judged side by side, a small edge is plenty and saves image tokens
+JUDGE_MAX_EDGE = 512
+JUDGE_JPEG_QUALITY = 80
+
+_executor = None
+_executor_lock = threading.Lock()
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_FETCH_WORKERS, thread_name_prefix="image-fetch"
+            )
+        return _executor
+
+
+def _host_limit(url: str) -> threading.BoundedSemaphore:
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(MAX_FETCHES_PER_HOST)
+        return _host_limits[host]
+
+
+def fetch_image(url: str) -> bytes:
+    outcome = "ok"
+    try:
+        with _host_limit(url):
+            with metrics.timer("clanki_provider_seconds", provider="images"):
+                res = get_session().get(url, timeout=FETCH_TIMEOUT)
+        if not res.ok:
+            outcome = res.status_code
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        metrics.inc(
+            "clanki_provider_requests_total", provider="images", outcome=outcome
+        )
+    res.raise_for_status()
+    metrics.inc("clanki_provider_bytes_total", len(res.content), provider="images")
+    return res.content
+
+
+def _fetch_or_none(url: str) -> bytes | None:
+    try:
+        return fetch_image(url)
+    except Exception as e:
+        print("Error fetching image", e)
+        return None
+
+
+def fetch_candidate_images(urls: list) -> tuple[list, dict]:
+    """Download every candidate once, keeping the raw bytes of supported images"""
+    candidates = []
+    stats = {"requests": 0, "bytes": 0, "requests_saved": 0, "bytes_saved": 0}
+
+    # Downloads run concurrently, results come back in Brave's ranking order
+    for url, raw in zip(urls, _get_executor().map(_fetch_or_none, urls)):
+        stats["requests"] += 1
+        if raw is None:
+            continue
+
+        stats["bytes"] += len(raw)
+
+        # MIME is sniffed from the bytes we already hold, Content-Type headers are often wrong
+        mime_type = detected_mime_from_bytes(raw)
+        if mime_type not in MIME_TYPES:
+            continue
+
+        candidates.append({"url": url, "file_type": mime_type, "raw": raw})
+
+        # Previously every survivor was downloaded a second time to be encoded
+        stats["requests_saved"] += 1
+        stats["bytes_saved"] += len(raw)
+
+    return candidates, stats
+
+
+def fetch_original(urls: list, stats: dict) -> dict | None:
+    """Download the first of `urls` that turns out to be a supported image.
+
+    The match includes its `raw` bytes, pop them before caching it.
+    """
+    for url in urls:
+        raw = _fetch_or_none(url)
+        stats["requests"] += 1
+        if raw is None:
+            continue
+
+        stats["bytes"] += len(raw)
+        mime_type = detected_mime_from_bytes(raw)
+        if mime_type in MIME_TYPES:
+            return {"url": url, "file_type": mime_type, "raw": raw}
+
+        print(f"{url} isn't a supported image, trying the next best")
+
+    return None
+
+
+def image_block(raw: bytes, media_type: str) -> dict:
+    """Claude image content for the judge, the one place images are base64 encoded"""
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": media_type,
+            "data": base64.standard_b64encode(raw).decode("ascii"),
+        },
+    }
+
+
+def shrink_image(im: "Image.Image", max_edge: int = JUDGE_MAX_EDGE) -> "Image.Image":
+    """Return an RGB copy of the image that fits within max_edge"""
+    from PIL import Image
+
+    small = im.copy()
+    small.thumbnail((max_edge, max_edge))
+    if small.mode != "RGB":
+        # Flatten transparency onto white rather than the black convert() gives
+        rgba = small.convert("RGBA")
+        small = Image.new("RGB", rgba.size, (255, 255, 255))
+        small.paste(rgba, mask=rgba.getchannel("A"))
+    return small
+
+
+def encode_jpeg(im: "Image.Image", quality: int = JUDGE_JPEG_QUALITY) -> bytes:
+    output = io.BytesIO()
+    im.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def prepare_for_judging(
+    candidates: list,
+    stats: dict,
+    limit: int = JUDGE_LIMIT,
+    max_edge: int = JUDGE_MAX_EDGE,
+    quality: int = JUDGE_JPEG_QUALITY,
+) -> list:
+    """Shrink each candidate and prune the set down to `limit` for the judge.
+
+    Each survivor gets the `judge_raw` bytes and `judge_type` to send, base64
+    encoding is left to image_block when the message is built.
+    """
+    from PIL import Image
+
+    inspected = []
+
+    for candidate in candidates:
+        try:
+            with Image.open(io.BytesIO(candidate["raw"])) as im:
+                candidate["width"], candidate["height"] = im.size
+                small = shrink_image(im, max_edge)
+            candidate["ahash"] = average_hash(small)
+            judge_raw, judge_type = encode_jpeg(small, quality), "image/jpeg"
+        except Exception as e:
+            print("Error resizing image", e)
+            continue
+
+        # Already small images can come out bigger as JPEG, keep whichever is smaller
+        if len(judge_raw) >= len(candidate["raw"]):
+            judge_raw, judge_type = candidate["raw"], candidate["file_type"]
+
+        candidate["judge_raw"] = judge_raw
+        candidate["judge_type"] = judge_type
+        inspected.append(candidate)
+
+    prepared = prune_candidates(inspected, limit)
+
+    stats["judge_bytes"] = 0
+    stats["resize_bytes_saved"] = 0
+    stats["judged"] = len(prepared)
+    for candidate in prepared:
+        judge_bytes = len(candidate["judge_raw"])
+        stats["judge_bytes"] += judge_bytes
+        stats["resize_bytes_saved"] += len(candidate["raw"]) - judge_bytes
+
+    return prepared
+
+
+def report_fetch_stats(phrase: str, stats: dict) -> None:
+    sys.stdout.write(
+        f"{phrase}: {stats['requests']} image requests, {stats['bytes']} bytes "
+        f"(saved {stats['requests_saved']} requests, {stats['bytes_saved']} bytes), "
+        f"{stats.get('judged', 0)} images, {stats.get('judge_bytes', 0)} bytes sent to the judge "
+        f"(saved {stats.get('resize_bytes_saved', 0)} bytes by resizing)\n"
+    )
@@ -0,0 +1,275 @@
+import csv
+import io
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import CACHE_DIR
+
+JOBS_DB = os.getenv("CLANKI_JOBS_DB", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+# Each job carries its own RunConfig, so several can build decks side by side
+JOB_WORKERS = 4
+# Running jobs are touched this often by the process working on them, one that
+# hasn't been touched for STALE_AFTER belonged to a process that died. It's also
+# how soon a cancel made through another process reaches the job.
+HEARTBEAT_EVERY = 10
+STALE_AFTER = 4 * HEARTBEAT_EVERY
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobQueue:
+    """Background deck generation backed by a SQLite table so jobs survive a restart.
+
+    `run_job(phrases, settings, emit, cancel)` does the work and returns the
+    CSV content. It reports progress by calling `emit` with event dicts, each
+    finished card as a "row" event, and should stop once `cancel` is set.
+    Events are passed on to anyone subscribed to the job. Unfinished jobs
+    are picked back up by `start()`, and a background thread keeps
+    re-queuing jobs whose process stopped touching them.
+    """
+
+    def __init__(self, run_job, path: str = JOBS_DB, workers: int = JOB_WORKERS):
+        self.run_job = run_job
+        self.path = path
+        self.workers = workers
+        self._conn = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._subscribers = {}
+        self._cancels = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    phrases TEXT NOT NULL,
+                    settings TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_rows (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    card TEXT NOT NULL,
+                    PRIMARY KEY (job_id, idx)
+                )"""
+            )
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def start(self) -> None:
+        """Pick up queued and abandoned jobs and start the workers, once per process"""
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="job"
+            )
+
+        for row in self._execute(
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created"
+        ).fetchall():
+            self._executor.submit(self._run, row["id"])
+        self._requeue_stale()
+        threading.Thread(target=self._monitor, name="job-monitor", daemon=True).start()
+
+    def _requeue_stale(self) -> None:
+        stale = self._execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND updated < ? "
+            "ORDER BY created",
+            (time.time() - STALE_AFTER,),
+        ).fetchall()
+        for row in stale:
+            # Conditional, so only one process picks up each abandoned job
+            requeued = self._execute(
+                "UPDATE jobs SET status = 'queued' "
+                "WHERE id = ? AND status = 'running' AND updated < ?",
+                (row["id"], time.time() - STALE_AFTER),
+            ).rowcount
+            if requeued:
+                print(f"Job {row['id']} was abandoned, running it again")
+                self._executor.submit(self._run, row["id"])
+
+    def _heartbeat(self) -> None:
+        with self._lock:
+            running = dict(self._cancels)
+        for job_id, cancel in running.items():
+            row = self._execute(
+                "SELECT status FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is not None and row["status"] == "cancelled":
+                # Cancelled by another process, which can't reach this Event
+                if not cancel.is_set():
+                    cancel.set()
+                    self._publish(job_id, {"type": "cancelled"})
+                continue
+            self._execute(
+                "UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'",
+                (time.time(), job_id),
+            )
+
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(HEARTBEAT_EVERY)
+            try:
+                self._heartbeat()
+                self._requeue_stale()
+            except Exception as e:
+                print("Job monitor failed", e)
+
+    def submit(self, phrases: list, settings: dict) -> str:
+        self.start()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, status, phrases, settings, total, created, updated) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(phrases), json.dumps(settings), len(phrases), now, now),
+        )
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        self.start()
+        row = self._execute(
+            "SELECT id, status, total, completed, error, created, updated "
+            "FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def result(self, job_id: str) -> str | None:
+        """The finished CSV, or the cards done so far if the job was cancelled"""
+        row = self._execute(
+            "SELECT status, result FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row["status"] == "done":
+            return row["result"]
+        if row["status"] != "cancelled":
+            return None
+
+        output = io.StringIO()
+        cw = csv.writer(output)
+        for card in self._execute(
+            "SELECT card FROM job_rows WHERE job_id = ? ORDER BY idx", (job_id,)
+        ).fetchall():
+            cw.writerow(json.loads(card["card"]))
+        return output.getvalue()
+
+    def cancel(self, job_id: str) -> bool:
+        cancelled = self._execute(
+            "UPDATE jobs SET status = 'cancelled', updated = ? "
+            "WHERE id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id),
+        ).rowcount
+        if not cancelled:
+            return False
+
+        with self._lock:
+            cancel = self._cancels.get(job_id)
+        if cancel is not None:
+            cancel.set()
+        self._publish(job_id, {"type": "cancelled"})
+        return True
+
+    def subscribe(self, job_id: str) -> queue.Queue:
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append(events)
+        return events
+
+    def unsubscribe(self, job_id: str, events: queue.Queue) -> None:
+        with self._lock:
+            listeners = self._subscribers.get(job_id, [])
+            if events in listeners:
+                listeners.remove(events)
+            if not listeners:
+                self._subscribers.pop(job_id, None)
+
+    def _publish(self, job_id: str, event: dict) -> None:
+        with self._lock:
+            listeners = list(self._subscribers.get(job_id, []))
+        for events in listeners:
+            events.put(event)
+
+    def _emit(self, job_id: str, event: dict) -> None:
+        if event.get("type") == "row":
+            self._execute(
+                "INSERT OR REPLACE INTO job_rows VALUES (?, ?, ?)",
+                (job_id, event["index"], json.dumps(event["card"])),
+            )
+            self._execute(
+                "UPDATE jobs SET completed = completed + 1, updated = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+        self._publish(job_id, event)
+
+    def _run(self, job_id: str) -> None:
+        # Only one worker gets to claim a job, even across processes
+        claimed = self._execute(
+            "UPDATE jobs SET status = 'running', completed = 0, updated = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id),
+        ).rowcount
+        if not claimed:
+            return
+
+        self._execute("DELETE FROM job_rows WHERE job_id = ?", (job_id,))
+        row = self._execute(
+            "SELECT phrases, settings FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        cancel = threading.Event()
+        with self._lock:
+            self._cancels[job_id] = cancel
+
+        try:
+            csv_content = self.run_job(
+                json.loads(row["phrases"]),
+                json.loads(row["settings"]),
+                lambda event: self._emit(job_id, event),
+                cancel,
+            )
+        except Exception as e:
+            if not cancel.is_set():
+                print(f"Job {job_id} failed", e)
+                self._execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated = ? "
+                    "WHERE id = ?",
+                    (str(e), time.time(), job_id),
+                )
+                self._publish(job_id, {"type": "failed", "error": str(e)})
+            return
+        finally:
+            with self._lock:
+                self._cancels.pop(job_id, None)
+
+        self._execute(
+            "UPDATE jobs SET status = 'done', result = ?, updated = ? "
+            "WHERE id = ? AND status = 'running'",
+            (csv_content, time.time(), job_id),
+        )
+        self._publish(job_id, {"type": "done"})
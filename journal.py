@@ -0,0 +1,67 @@
+import json
+import os
+import pathlib
+import threading
+
+# Only what the output needs is journaled, search results can be large
+JOURNAL_FIELDS = ("phrase", "translation", "image")
+
+
+def journal_path(input_file: str) -> str:
+    return str(pathlib.Path(input_file).with_suffix(".journal.jsonl"))
+
+
+class Journal:
+    """Append-only record of finished rows so an interrupted run can pick up again.
+
+    Each line holds a row's input index and its phrase, translation and
+    image. A line is flushed as soon as the row finishes, so at worst the
+    row in flight when the process died is lost.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        """Journaled rows by input index, a torn last line is skipped.
+
+        Callers should check each row's phrase against the input, an edited
+        file means the row has to be redone.
+        """
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(entry.get("index"), int):
+                    done[entry["index"]] = {
+                        field: entry.get(field) for field in JOURNAL_FIELDS
+                    }
+        return done
+
+    def append(self, index: int, row: dict) -> None:
+        entry = {"index": index, **{field: row.get(field) for field in JOURNAL_FIELDS}}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
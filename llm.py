@@ -1,22 +1,70 @@
 import os
+import threading
+import time
 
-from anthropic import (Anthropic, APIConnectionError, APIStatusError,
-                       RateLimitError)
 from dotenv import load_dotenv
 
+from metrics import metrics
+from ratelimit import claude_limiter
+
 load_dotenv()
 
-claude_client = Anthropic(api_key=os.getenv("CLAUDE_KEY"))
+BATCH_POLL_INTERVAL = 30
+USAGE_FIELDS = {
+    "input_tokens": "input",
+    "output_tokens": "output",
+    "cache_read_input_tokens": "cache_read",
+    "cache_creation_input_tokens": "cache_creation",
+}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_claude_client():
+    """The process-wide Anthropic client, created on first use.
+
+    The SDK takes over a second to import, so runs that never reach Claude,
+    such as a rerun answered from the cache, don't pay for it.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from anthropic import Anthropic
+
+            # CLAUDE_BASE_URL lets batch runs be pointed at a local fake server.
+            # Retries are left to claude_limiter so every thread backs off together
+            _client = Anthropic(
+                api_key=os.getenv("CLAUDE_KEY"),
+                base_url=os.getenv("CLAUDE_BASE_URL"),
+                max_retries=0,
+            )
+        return _client
+
+
+def record_usage(message, mode: str) -> None:
+    usage = getattr(message, "usage", None)
+    for field, kind in USAGE_FIELDS.items():
+        tokens = getattr(usage, field, None)
+        if tokens:
+            metrics.inc("clanki_claude_tokens_total", tokens, kind=kind, mode=mode)
 
 
 class LLMClient:
     def fetch(self, model, max_tokens, system, messages):
+        from anthropic import APIConnectionError, APIStatusError, RateLimitError
+
+        claude_client = get_claude_client()
         try:
-            message = claude_client.messages.create(
-                model=model,
-                max_tokens=max_tokens,
-                system=system,
-                messages=messages,
+            response = claude_limiter.call(
+                lambda: claude_client.messages.with_raw_response.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    system=system,
+                    messages=messages,
+                ),
+                retry_on=(APIConnectionError,),
             )
 
         except APIConnectionError:
@@ -26,4 +74,41 @@ class LLMClient:
         except APIStatusError:
             raise
 
+        claude_limiter.observe(response.headers)
+        message = response.parse()
+        record_usage(message, "messages")
         return message
+
+    def batch(self, requests, poll_interval=BATCH_POLL_INTERVAL):
+        """Run many requests through the Message Batches API and wait for them.
+
+        `requests` maps a custom ID to the same model, max_tokens, system and
+        messages params that fetch takes. Returns custom ID to message for the
+        requests that succeeded, failures are reported and left out.
+        """
+        claude_client = get_claude_client()
+        batch = claude_limiter.call(
+            lambda: claude_client.messages.batches.create(
+                requests=[
+                    {"custom_id": custom_id, "params": params}
+                    for custom_id, params in requests.items()
+                ]
+            )
+        )
+        print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+        while batch.processing_status != "ended":
+            time.sleep(poll_interval)
+            batch = claude_limiter.call(
+                lambda: claude_client.messages.batches.retrieve(batch.id)
+            )
+
+        messages = {}
+        for entry in claude_client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                messages[entry.custom_id] = entry.result.message
+                record_usage(entry.result.message, "batch")
+            else:
+                print(f"Batch request {entry.custom_id} {entry.result.type}")
+
+        return messages
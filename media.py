@@ -0,0 +1,68 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+
+from cache import CACHE_DIR
+from images import fetch_image
+from validate_b64 import detected_mime_from_bytes
+
+# Point this at a profile's collection.media folder to write straight into Anki
+MEDIA_DIR = os.getenv("CLANKI_MEDIA_DIR", os.path.join(CACHE_DIR, "media"))
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+
+def media_filename(raw: bytes, mime_type: str) -> str:
+    """Anki media name for an image, plain ASCII with no folders, named by content"""
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    return f"clanki-{digest}{EXTENSIONS.get(mime_type, '.jpg')}"
+
+
+class MediaStore:
+    """Content addressed folder of card images shared by every deck.
+
+    The same picture chosen for two phrases, or in two different decks, is
+    stored once under the same name.
+    """
+
+    def __init__(self, path: str = MEDIA_DIR):
+        self.path = path
+        self.added = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    def file_path(self, filename: str) -> str:
+        return os.path.join(self.path, filename)
+
+    def has(self, filename: str) -> bool:
+        return os.path.exists(self.file_path(filename))
+
+    def add(self, raw: bytes, mime_type: str) -> str:
+        filename = media_filename(raw, mime_type)
+        if self.has(filename):
+            with self._lock:
+                self.reused += 1
+            return filename
+
+        pathlib.Path(self.path).mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a half written file never has the final name
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, self.file_path(filename))
+        with self._lock:
+            self.added += 1
+        return filename
+
+    def store_image(self, image: dict, raw: bytes | None = None) -> dict:
+        """The image with its media filename set, downloading it if need be"""
+        if image.get("media") and self.has(image["media"]):
+            with self._lock:
+                self.reused += 1
+            return image
+
+        if raw is None:
+            raw = fetch_image(image.get("url"))
+        mime_type = detected_mime_from_bytes(raw)
+        return {**image, "media": self.add(raw, mime_type)}
@@ -0,0 +1,171 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds in seconds, wide enough for a cache hit through to a slow Claude call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimated from the buckets, the bound of the one holding the q-th value"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Counters and timing histograms by name and labels, shared by every thread.
+
+    Names follow Prometheus conventions, e.g. clanki_provider_seconds with a
+    provider label, so `prometheus()` can serve them as they are. `snapshot()`
+    gives the same numbers as plain JSON.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str) -> None:
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            result = {"counters": {}, "histograms": {}}
+            for (name, key), value in counters:
+                result["counters"].setdefault(name, []).append(
+                    {"labels": dict(key), "value": value}
+                )
+            for (name, key), hist in histograms:
+                result["histograms"].setdefault(name, []).append(
+                    {
+                        "labels": dict(key),
+                        "count": hist.count,
+                        "sum": hist.sum,
+                        "max": hist.max,
+                        "p50": hist.quantile(0.5),
+                        "p95": hist.quantile(0.95),
+                    }
+                )
+
+        result["ratios"] = {"cache_hit_rate": self.cache_hit_rate()}
+        return result
+
+    def cache_hit_rate(self) -> float | None:
+        hits = self.counter("clanki_cache_lookups_total", result="hit")
+        misses = self.counter("clanki_cache_lookups_total", result="miss")
+        return hits / (hits + misses) if hits + misses else None
+
+    def prometheus(self) -> str:
+        """The text exposition format served at /metrics"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            described = set()
+
+            def header(name: str, kind: str) -> None:
+                if name in described:
+                    return
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            for (name, key), value in counters:
+                header(name, "counter")
+                lines.append(f"{name}{_format_labels(key)} {value}")
+
+            for (name, key), hist in histograms:
+                header(name, "histogram")
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    le = _format_labels(key, (("le", str(bound)),))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = _format_labels(key, (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{le} {hist.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {hist.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("clanki_stage_seconds", "Time spent in each pipeline stage call")
+metrics.describe("clanki_stage_items_total", "Items that went through each stage")
+metrics.describe("clanki_provider_seconds", "Time per request to each provider")
+metrics.describe(
+    "clanki_provider_requests_total", "Requests to each provider by outcome"
+)
+metrics.describe("clanki_provider_bytes_total", "Response bytes from each provider")
+metrics.describe(
+    "clanki_provider_throttled_seconds_total",
+    "Seconds spent waiting on each provider's rate limiter",
+)
+metrics.describe("clanki_validate_seconds", "Time spent validating judged images")
+metrics.describe("clanki_claude_tokens_total", "Claude tokens used, by kind")
+metrics.describe("clanki_cache_lookups_total", "Result cache lookups, hit or miss")
@@ -0,0 +1,610 @@
+"""The card pipeline shared by run.py and web.py.
+
+Phrases come in from a source, go through the translate -> classify ->
+search -> judge stages and the finished cards go out to a sink. Each stage
+is a scheduler.Stage with its own workers and batch size, so the front-ends
+only decide where phrases come from and where cards go.
+"""
+
+import json
+import os
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable
+
+import requests
+from dotenv import load_dotenv
+
+from cache import cache_key, prompt_hash
+from classify import classify_in_chunks
+from config import RunConfig
+from deck_files import STREAM_WINDOW, format_card, windows
+from dedupe import SingleFlight, UsedImages, normalize_phrase, run_deduplicated
+from http_client import get_session
+from images import (
+    fetch_candidate_images,
+    fetch_original,
+    image_block,
+    prepare_for_judging,
+    report_fetch_stats,
+)
+from journal import Journal
+from llm import LLMClient
+from metrics import metrics
+from prefilter import rank_results
+from prompts import image_prompt, phrase_prompt
+from ratelimit import brave_limiter
+from scheduler import (
+    CLASSIFY_BATCH_SIZE,
+    MESSAGE_BATCH_SIZE,
+    TRANSLATE_BATCH_SIZE,
+    Stage,
+)
+from translation import translate_batch
+from validate_b64 import is_valid_image
+
+load_dotenv()
+
+
+# BRAVE_SEARCH_URL lets the benchmark point searches at its stub server
+BRAVE_URL = os.getenv(
+    "BRAVE_SEARCH_URL", "https://api.search.brave.com/res/v1/images/search"
+)
+BRAVE_HEADERS = {
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip",
+    "X-Subscription-Token": os.getenv("BRAVE_KEY"),
+}
+
+PREFILL = "["
+
+
+def get_image_type(image_url) -> str:
+    parsed_url = urllib.parse.urlsplit(image_url)
+    path_split = parsed_url.path.split(".")
+    file_type = path_split[len(path_split) - 1]
+
+    if file_type == "jpg":
+        return "jpeg"
+
+    return file_type
+
+
+def brave_img_search(phrase: str, count: int = 20) -> str:
+    def search() -> requests.Response:
+        res = get_session().get(
+            BRAVE_URL,
+            headers=BRAVE_HEADERS,
+            params={
+                "q": phrase,
+                "count": count,
+                "search_lang": "en-gb",
+                "safesearch": "strict",
+            },
+        )
+        res.raise_for_status()
+        metrics.inc("clanki_provider_bytes_total", len(res.content), provider="brave")
+        return res
+
+    try:
+        return brave_limiter.call(search).json()
+
+    except requests.exceptions.HTTPError:
+        raise
+
+    except Exception:
+        raise
+
+
+def classify_phrase(phrases: list, config: RunConfig) -> list:
+    return classify_in_chunks(
+        phrases, config.source_language_name, config.model, config.use_batch
+    )
+
+
+def search_phrase(phrase: str, config: RunConfig) -> dict:
+    key = cache_key("brave", phrase, config.candidate_count)
+    cached = config.cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        data = brave_img_search(phrase, config.candidate_count)
+    except requests.exceptions.HTTPError as e:
+        print(f"HTTPError: {e}")
+        raise
+
+    config.cache.set(key, data)
+    return data
+
+
+def brave_top_result(phrase: str, data: dict) -> dict:
+    """Brave's first result, or no image at all when it found nothing"""
+    results = data.get("results") or []
+    if not results:
+        print(f"Brave found no images for '{phrase}', its card won't have one")
+        return {"url": "", "file_type": ""}
+
+    url = results[0].get("properties").get("url")
+    return {"url": url, "file_type": get_image_type(url)}
+
+
+def prepare_judgement(phrase: str, data: dict, config: RunConfig) -> dict:
+    """Fetch and shrink the candidates for a phrase and build the judge request.
+
+    Returns {"image": ...} straight away when Claude doesn't need asking.
+    """
+    # If user opts out of AI, Claude isn't called and we rely on Brave's confidence score, image immediately returned
+    if not config.use_ai:
+        return {"image": brave_top_result(phrase, data)}
+
+    # Only the most promising results by Brave's own metadata are downloaded
+    ranked_results = rank_results(data.get("results") or [])
+    image_urls = [i.get("properties").get("url") for i in ranked_results]
+    if config.use_thumbnails:
+        # Judge Brave's small CDN thumbnails, only the winner's original is fetched
+        fetch_urls = [
+            i.get("thumbnail", {}).get("src") or i.get("properties").get("url")
+            for i in ranked_results
+        ]
+    else:
+        fetch_urls = image_urls
+    originals = dict(zip(fetch_urls, image_urls))
+
+    # Same query, candidates and prompt means the same verdict, skip the downloads too
+    key = cache_key(
+        "judge", config.model, prompt_hash(image_prompt), phrase, fetch_urls
+    )
+    cached = config.cache.get(key)
+    if cached is not None:
+        return {"image": cached}
+
+    candidates, fetch_stats = fetch_candidate_images(fetch_urls)
+
+    # Checked straight from the downloaded bytes, nothing is base64 encoded yet
+    valid_candidates = [
+        c for c in candidates if is_valid_image(c["raw"], c["file_type"])
+    ]
+    valid_candidates = prepare_for_judging(
+        valid_candidates,
+        fetch_stats,
+        max_edge=config.judge_max_edge,
+        quality=config.judge_jpeg_quality,
+    )
+    if not valid_candidates:
+        # Nothing for Claude to look at, so take Brave's word for it
+        print(f"None of the images for '{phrase}' could be used, taking Brave's first")
+        report_fetch_stats(phrase, fetch_stats)
+        return {"image": brave_top_result(phrase, data)}
+
+    # Encoded once here, the judge's copy isn't needed after that
+    images_prompt_data = [
+        image_block(c.pop("judge_raw"), c["judge_type"]) for c in valid_candidates
+    ]
+    updated_image_prompt = image_prompt.replace("{text}", f"<text>{phrase}</text>")
+
+    images_prompt_data.append({"type": "text", "text": updated_image_prompt})
+    messages = [
+        {"role": "user", "content": images_prompt_data},
+        {"role": "assistant", "content": PREFILL},
+    ]
+
+    return {
+        "key": key,
+        "candidates": valid_candidates,
+        "originals": originals,
+        "stats": fetch_stats,
+        "request": {
+            "model": config.model,
+            "max_tokens": 1024,
+            "system": "You are an image classifier and rater",
+            "messages": messages,
+        },
+    }
+
+
+def finish_judgement(
+    phrase: str, judgement: dict, message, config: RunConfig
+) -> dict:
+    valid_candidates = judgement["candidates"]
+    fetch_stats = judgement["stats"]
+
+    final_completion_list = None
+    if message is not None:
+        final_completion_str = f"{PREFILL}{message.content[0].text}"
+        try:
+            final_completion_list = json.loads(final_completion_str)
+        except ValueError:
+            print(f"Couldn't read Claude's scores for '{phrase}'")
+
+    if not final_completion_list:
+        # Claude couldn't be asked or gave no scores, use the prefilter's ranking
+        best_image_indexes = list(range(len(valid_candidates)))
+    else:
+        # Highest score first, ties keep Brave's order
+        best_image_indexes = sorted(
+            range(min(len(final_completion_list), len(valid_candidates))),
+            key=lambda i: final_completion_list[i],
+            reverse=True,
+        )
+
+    cacheable = bool(final_completion_list)
+    if config.use_thumbnails:
+        # Fall back to the next best if the winner's original is dead
+        best_image_match = fetch_original(
+            [
+                judgement["originals"][valid_candidates[i].get("url")]
+                for i in best_image_indexes
+            ],
+            fetch_stats,
+        )
+        if best_image_match is None:
+            # The winner's thumbnail still makes a card, the originals may be back later
+            print(f"None of the originals for '{phrase}' downloaded, using a thumbnail")
+            thumbnail = valid_candidates[best_image_indexes[0]]
+            best_image_match = {
+                "url": thumbnail.get("url"),
+                "file_type": thumbnail.get("file_type"),
+                "raw": thumbnail.get("raw"),
+            }
+            cacheable = False
+        raw = best_image_match.pop("raw")
+    else:
+        best_image = valid_candidates[best_image_indexes[0]]
+        best_image_match = {
+            "url": best_image.get("url"),
+            "file_type": best_image.get("file_type"),
+        }
+        raw = best_image.get("raw")
+
+    best_image_match = store_media(best_image_match, config, raw)
+    report_fetch_stats(phrase, fetch_stats)
+    if cacheable:
+        config.cache.set(judgement["key"], best_image_match)
+    return best_image_match
+
+
+def store_media(image: dict, config: RunConfig, raw: bytes = None) -> dict:
+    if not image.get("url"):
+        return image
+    if config.media is None:
+        # A cached verdict can name a file saved by an earlier --media run,
+        # without a media folder this deck has to link to the URL instead
+        return {key: value for key, value in image.items() if key != "media"}
+
+    try:
+        return config.media.store_image(image, raw)
+    except Exception as e:
+        # The card can still link to the image where it's hosted
+        print(f"Couldn't save {image.get('url')} to the media folder", e)
+        return image
+
+
+def judge_phrase(phrase: str, data: dict, config: RunConfig) -> dict:
+    judgement = prepare_judgement(phrase, data, config)
+    if "image" in judgement:
+        return store_media(judgement["image"], config)
+
+    # Imported here, the SDK is slow to load and only needed once Claude is called
+    import anthropic
+
+    request = judgement["request"]
+    try:
+        llm_client = LLMClient()
+        message = llm_client.fetch(
+            request["model"],
+            request["max_tokens"],
+            request["system"],
+            request["messages"],
+        )
+    except anthropic.APIConnectionError as e:
+        print("The server could not be reached")
+        message = None
+    except anthropic.RateLimitError as e:
+        print("Still rate limited after backing off, using Brave's ranking")
+        message = None
+    except anthropic.APIStatusError as e:
+        print(e)
+        message = None
+
+    return finish_judgement(phrase, judgement, message, config)
+
+
+def judge_phrases_in_batch(
+    phrases: list, search_results: list, config: RunConfig
+) -> list:
+    """Judge many phrases with one Message Batches API request"""
+    with ThreadPoolExecutor(max_workers=config.workers["judge"]) as pool:
+        judgements = list(
+            pool.map(
+                lambda phrase, data: prepare_judgement(phrase, data, config),
+                phrases,
+                search_results,
+            )
+        )
+
+    batch_requests = {
+        f"judge-{i}": judgement["request"]
+        for i, judgement in enumerate(judgements)
+        if "image" not in judgement
+    }
+    messages = LLMClient().batch(batch_requests) if batch_requests else {}
+
+    image_matches = []
+    for i, (phrase, judgement) in enumerate(zip(phrases, judgements)):
+        if "image" in judgement:
+            image_matches.append(store_media(judgement["image"], config))
+            continue
+
+        # A request the batch failed falls back to the prefilter's ranking
+        message = messages.get(f"judge-{i}")
+        image_matches.append(finish_judgement(phrase, judgement, message, config))
+
+    return image_matches
+
+
+def translate_phrases(inputs: list, config: RunConfig) -> list:
+    sys.stdout.write(f"Translating phrases...\n")
+    languages = (config.source_language, config.target_language)
+    keys = [cache_key("translate", *languages, i) for i in inputs]
+    translations = [config.cache.get(key) for key in keys]
+
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+    if missing:
+        fresh_translations, round_trips = translate_batch(
+            [inputs[i] for i in missing], *languages
+        )
+        sys.stdout.write(
+            f"Translated {len(missing)} phrases in {round_trips} requests\n"
+        )
+        for i, translation in zip(missing, fresh_translations):
+            translations[i] = translation
+            if translation is not None:
+                config.cache.set(keys[i], translation)
+
+    # The ones that worked are cached, so a resumed run only redoes the failures
+    failed = [i for i, translation in zip(inputs, translations) if translation is None]
+    if failed:
+        raise ValueError(
+            f"Couldn't translate {len(failed)} phrases, starting with '{failed[0]}'"
+        )
+
+    return translations
+
+
+def translate_rows(rows: list, config: RunConfig) -> list:
+    translations = translate_phrases([row["phrase"] for row in rows], config)
+    for row, translation in zip(rows, translations):
+        row["translation"] = translation
+    return rows
+
+
+def classify_rows(rows: list, config: RunConfig) -> list:
+    keys = [
+        cache_key(
+            "classify",
+            config.source_language_name,
+            config.model,
+            prompt_hash(phrase_prompt),
+            row["phrase"],
+        )
+        for row in rows
+    ]
+    queries = [config.cache.get(key) for key in keys]
+
+    # Only phrases we haven't seen before are sent to Claude
+    missing = [i for i, query in enumerate(queries) if query is None]
+    if missing:
+        fresh_queries = classify_phrase(
+            [rows[i]["phrase"] for i in missing], config
+        )
+        if fresh_queries is None or len(fresh_queries) != len(missing):
+            raise ValueError("Could not generate search queries for your phrases")
+
+        for i, query in zip(missing, fresh_queries):
+            queries[i] = query
+            config.cache.set(keys[i], query)
+
+    for row, query in zip(rows, queries):
+        row["query"] = query
+    return rows
+
+
+def search_row(row: dict, config: RunConfig, searches: SingleFlight) -> dict:
+    # Different phrases often boil down to the same query, search it once
+    row["search_results"] = searches.do(
+        normalize_phrase(row["query"]), lambda: search_phrase(row["query"], config)
+    )
+    return row
+
+
+def judge_row(
+    row: dict, config: RunConfig, judgements: SingleFlight, used_images: UsedImages
+) -> dict:
+    query = row["query"]
+    key = normalize_phrase(query)
+    if not config.distinct_images:
+        row["image"] = judgements.do(
+            key, lambda: judge_phrase(query, row["search_results"], config)
+        )
+        return row
+
+    # Rows sharing a query are judged one after another, each without the
+    # images picked before it
+    with used_images.lock(key):
+        data = used_images.exclude(key, row["search_results"])
+        row["image"] = judge_phrase(query, data, config)
+        used_images.add(key, row["image"].get("url"))
+    return row
+
+
+def judge_rows(
+    rows: list, config: RunConfig, judgements: SingleFlight, used_images: UsedImages
+) -> list:
+    # One batch request per distinct query, repeats are filled in afterwards
+    firsts = {}
+    for row in rows:
+        firsts.setdefault(normalize_phrase(row["query"]), row)
+
+    images = judge_phrases_in_batch(
+        [row["query"] for row in firsts.values()],
+        [row["search_results"] for row in firsts.values()],
+        config,
+    )
+    for (key, row), image in zip(firsts.items(), images):
+        row["image"] = image
+        used_images.add(key, image.get("url"))
+
+    for row in rows:
+        first = firsts[normalize_phrase(row["query"])]
+        if row is first:
+            continue
+        if config.distinct_images:
+            judge_row(row, config, judgements, used_images)
+        else:
+            row["image"] = first["image"]
+    return rows
+
+
+def build_stages(config: RunConfig) -> list:
+    workers = config.workers
+    searches = SingleFlight()
+    judges = {
+        "config": config,
+        "judgements": SingleFlight(),
+        "used_images": UsedImages(),
+    }
+    # Message Batches are slow to turn around, so give each one plenty of phrases
+    classify_batch_size = (
+        MESSAGE_BATCH_SIZE if config.use_batch else CLASSIFY_BATCH_SIZE
+    )
+    if config.use_batch:
+        judge_stage = Stage(
+            "judge",
+            partial(judge_rows, **judges),
+            workers["judge"],
+            batch_size=MESSAGE_BATCH_SIZE,
+        )
+    else:
+        judge_stage = Stage(
+            "judge", partial(judge_row, **judges), workers["judge"]
+        )
+
+    return [
+        Stage(
+            "translate",
+            partial(translate_rows, config=config),
+            workers["translate"],
+            batch_size=TRANSLATE_BATCH_SIZE,
+        ),
+        Stage(
+            "classify",
+            partial(classify_rows, config=config),
+            workers["classify"],
+            batch_size=classify_batch_size,
+        ),
+        Stage(
+            "search",
+            partial(search_row, config=config, searches=searches),
+            workers["search"],
+        ),
+        judge_stage,
+    ]
+
+
+def process_window(
+    phrases: list,
+    offset: int,
+    config: RunConfig,
+    stages: list | None = None,
+    journal: Journal | None = None,
+    finished: dict | None = None,
+    on_result: Callable = None,
+    on_stage: Callable = None,
+    cancel=None,
+) -> list:
+    """Rows for one window of the input, whose first phrase is number `offset`.
+
+    Rows already in `finished`, loaded from the journal, are reused and the
+    rest go through `stages`, build_stages(config) by default. Callbacks get
+    input-wide indexes and every fresh row is appended to `journal`.
+    """
+    finished = {} if finished is None else finished
+    rows = {}
+    for i, phrase in enumerate(phrases):
+        entry = finished.pop(offset + i, None)
+        if entry is not None and entry["phrase"] == phrase:
+            rows[i] = entry
+    remaining = [i for i in range(len(phrases)) if i not in rows]
+    if not remaining:
+        return [rows[i] for i in range(len(phrases))]
+
+    def row_done(index: int, row: dict) -> None:
+        if journal is not None:
+            journal.append(offset + remaining[index], row)
+        if on_result is not None:
+            on_result(offset + remaining[index], row)
+
+    def stage_done(stage: str, index: int, row: dict) -> None:
+        on_stage(stage, offset + remaining[index], row)
+
+    # Phrases flow through translate -> classify -> search -> judge concurrently
+    sys.stdout.write(f"Processing {len(remaining)} phrases...\n")
+    fresh_rows = run_deduplicated(
+        [phrases[i] for i in remaining],
+        stages if stages is not None else build_stages(config),
+        row_done,
+        stage_done if on_stage is not None else None,
+        cancel,
+    )
+    rows.update(zip(remaining, fresh_rows))
+    return [rows[i] for i in range(len(phrases))]
+
+
+def build_deck(
+    phrases: Iterable[str],
+    config: RunConfig,
+    sink,
+    stages: list | None = None,
+    journal: Journal | None = None,
+    finished: dict | None = None,
+    on_result: Callable = None,
+    on_stage: Callable = None,
+    on_window: Callable = None,
+    cancel=None,
+    window_size: int = STREAM_WINDOW,
+) -> int:
+    """Stream phrases from any iterable through the stages and into `sink`.
+
+    `sink` is anything with write(card, media) and flush(), a CardWriter or
+    an ApkgWriter. Phrases are read and processed `window_size` at a time
+    and each window's cards are written in input order, so memory doesn't
+    grow with the input. `on_window(written)` is called after every window.
+    Returns the number of cards written.
+    """
+    written = 0
+    for window in windows(phrases, window_size):
+        rows = process_window(
+            window,
+            written,
+            config,
+            stages,
+            journal,
+            finished,
+            on_result,
+            on_stage,
+            cancel,
+        )
+        for phrase, row in zip(window, rows):
+            sink.write(
+                format_card(phrase, row["translation"], row["image"]),
+                row["image"].get("media"),
+            )
+        sink.flush()
+        written += len(window)
+        if on_window is not None:
+            on_window(written)
+
+    return written
@@ -0,0 +1,98 @@
+import urllib.parse
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+CONFIDENCE_SCORES = {"high": 3, "medium": 2, "low": 1}
+# Candidates downloaded per phrase, ranked on Brave's metadata alone
+PREFETCH_LIMIT = 10
+# Candidates sent to the Claude judge per phrase
+JUDGE_LIMIT = 6
+MIN_EDGE = 200
+MAX_ASPECT_RATIO = 2.5
+# Average hashes this close (out of 64 bits) are treated as the same picture
+DUPLICATE_DISTANCE = 6
+
+
+def _source(result: dict) -> str:
+    return result.get("source") or urllib.parse.urlsplit(
+        result.get("properties", {}).get("url", "")
+    ).netloc
+
+
+def metadata_score(result: dict) -> float:
+    score = CONFIDENCE_SCORES.get(result.get("confidence"), 0)
+
+    properties = result.get("properties", {})
+    width, height = properties.get("width"), properties.get("height")
+    if width and height:
+        if min(width, height) < MIN_EDGE:
+            score -= 2
+        if max(width, height) / min(width, height) > MAX_ASPECT_RATIO:
+            score -= 1
+
+    if not result.get("thumbnail", {}).get("src"):
+        score -= 0.5
+
+    return score
+
+
+def rank_results(results: list, limit: int = PREFETCH_LIMIT) -> list:
+    """Order Brave results by their metadata and keep the best `limit` to download.
+
+    Each repeat from the same source domain is penalised a little, so the
+    judge sees some variety rather than ten crops from one stock site.
+    """
+    seen_sources = {}
+    scored = []
+
+    for position, result in enumerate(results):
+        source = _source(result)
+        repeats = seen_sources.get(source, 0)
+        seen_sources[source] = repeats + 1
+        scored.append((metadata_score(result) - 0.5 * repeats, -position, result))
+
+    scored.sort(key=lambda s: (s[0], s[1]), reverse=True)
+    return [result for _, _, result in scored[:limit]]
+
+
+def average_hash(im: "Image.Image") -> int:
+    from PIL import Image
+
+    small = im.convert("L").resize((8, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    mean = sum(pixels) / len(pixels)
+
+    bits = 0
+    for pixel in pixels:
+        bits = (bits << 1) | (pixel >= mean)
+    return bits
+
+
+def prune_candidates(candidates: list, limit: int = JUDGE_LIMIT) -> list:
+    """Drop near duplicates and poor shapes, keeping at most `limit` in rank order.
+
+    Candidates need `width`, `height` and `ahash` set. Small or oddly shaped
+    images are only used when there aren't enough good ones.
+    """
+    kept = []
+    fallback = []
+
+    for candidate in candidates:
+        if any(
+            (candidate["ahash"] ^ k["ahash"]).bit_count() <= DUPLICATE_DISTANCE
+            for k in kept + fallback
+        ):
+            continue
+
+        width, height = candidate["width"], candidate["height"]
+        if (
+            min(width, height) < MIN_EDGE
+            or max(width, height) / max(min(width, height), 1) > MAX_ASPECT_RATIO
+        ):
+            fallback.append(candidate)
+        else:
+            kept.append(candidate)
+
+    return (kept + fallback)[:limit]
@@ -0,0 +1,178 @@
+import email.utils
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+# Plan quotas, override them to match your own Brave and Anthropic plans
+BRAVE_REQUESTS_PER_SECOND = float(os.getenv("CLANKI_BRAVE_RPS", "1"))
+CLAUDE_REQUESTS_PER_MINUTE = float(os.getenv("CLANKI_CLAUDE_RPM", "50"))
+# Requests allowed back to back before the bucket has to refill
+CLAUDE_BURST = 4
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# 529 is Anthropic's "overloaded"
+RETRY_STATUSES = (429, 503, 529)
+ANTHROPIC_LIMITS = ("requests", "tokens", "input-tokens", "output-tokens")
+
+
+def retry_after_seconds(headers) -> float | None:
+    """Seconds to wait from a Retry-After header, given as seconds or an HTTP date"""
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def anthropic_reset_seconds(headers) -> float | None:
+    """Seconds until an exhausted Anthropic limit resets, None if none are exhausted"""
+    if headers is None:
+        return None
+
+    waits = []
+    for limit in ANTHROPIC_LIMITS:
+        remaining = headers.get(f"anthropic-ratelimit-{limit}-remaining")
+        reset = headers.get(f"anthropic-ratelimit-{limit}-reset")
+        if remaining is None or reset is None or int(remaining) > 0:
+            continue
+        try:
+            reset_at = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+        except ValueError:
+            continue
+        waits.append((reset_at - datetime.now(timezone.utc)).total_seconds())
+
+    return max(max(waits), 0.0) if waits else None
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    # Full jitter, so workers that were limited together don't retry together
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, BACKOFF_BASE)
+    return delay
+
+
+class RateLimiter:
+    """Token bucket for one provider, shared by every thread calling it.
+
+    `rate` tokens are added a second, up to `burst`, and each request takes
+    one. A 429 or an exhausted quota header pauses every caller rather than
+    just the one that saw it. `throttled` is the total seconds callers spent
+    waiting, summed across threads.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int = 1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0.0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    self.throttled += waited
+                    break
+                else:
+                    delay = (1 - self._tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+        metrics.inc(
+            "clanki_provider_throttled_seconds_total", waited, provider=self.name
+        )
+        return waited
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def observe(self, headers) -> None:
+        """Hold off early when a response says a quota has run out"""
+        wait = anthropic_reset_seconds(headers)
+        if wait:
+            self.pause(wait)
+
+    def _record(self, start: float, outcome) -> None:
+        elapsed = time.perf_counter() - start
+        metrics.observe("clanki_provider_seconds", elapsed, provider=self.name)
+        metrics.inc(
+            "clanki_provider_requests_total", provider=self.name, outcome=outcome
+        )
+
+    def call(self, fn, retry_on: tuple = ()):
+        """Call `fn` when a token is free, backing off and retrying when limited.
+
+        Errors whose response has a status in RETRY_STATUSES are retried, as
+        are any exception types in `retry_on`. Anything else is raised.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn()
+                self._record(start, "ok")
+                return result
+            except Exception as e:
+                response = getattr(e, "response", None)
+                status = getattr(response, "status_code", None)
+                self._record(start, status or type(e).__name__)
+                if attempt == MAX_RETRIES or not (
+                    status in RETRY_STATUSES or isinstance(e, retry_on)
+                ):
+                    raise
+
+                headers = getattr(response, "headers", None)
+                self.observe(headers)
+                delay = backoff_delay(attempt, retry_after_seconds(headers))
+                with self._lock:
+                    self.retries += 1
+                print(f"{self.name} returned {status or e}, retrying in {delay:.1f}s")
+                self.pause(delay)
+
+
+brave_limiter = RateLimiter("brave", BRAVE_REQUESTS_PER_SECOND)
+claude_limiter = RateLimiter("claude", CLAUDE_REQUESTS_PER_MINUTE / 60, CLAUDE_BURST)
+
+
+def report_throttling() -> None:
+    for limiter in (brave_limiter, claude_limiter):
+        if limiter.requests:
+            sys.stdout.write(
+                f"{limiter.name}: {limiter.requests} requests, {limiter.retries} "
+                f"retries, {limiter.throttled:.1f}s spent throttled\n"
+            )
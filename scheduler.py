@@ -0,0 +1,153 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+from metrics import metrics
+
+DEFAULT_WORKERS = {"translate": 4, "classify": 2, "search": 4, "judge": 4}
+CLASSIFY_BATCH_SIZE = 25
+TRANSLATE_BATCH_SIZE = 50
+# Phrases per Message Batches API request when running in batch mode
+MESSAGE_BATCH_SIZE = 200
+
+
+@dataclass
+class Stage:
+    """One step of the phrase pipeline.
+
+    `fn` takes a single item, or a list of items when `batch_size` is above 1,
+    and returns the updated item(s).
+    """
+
+    name: str
+    fn: Callable
+    workers: int = 1
+    batch_size: int = 1
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def run_pipeline(
+    items: list,
+    stages: list,
+    on_result: Callable = None,
+    on_stage: Callable = None,
+    cancel: threading.Event = None,
+) -> list:
+    """Push items through every stage concurrently, returning results in input order.
+
+    Each stage has its own worker pool, so item N can be in the last stage
+    while item N+1 is in the one before it. Batched stages collect whatever
+    items have arrived until the batch is full or the previous stage is done.
+    If any item fails, the first error is raised once every other item has
+    finished. `on_result(index, value)` is called as each item finishes and
+    `on_stage(stage_name, index, value)` as it clears each stage. Setting
+    `cancel` stops any further stage work and raises PipelineCancelled.
+    """
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    pools = [
+        ThreadPoolExecutor(max_workers=s.workers, thread_name_prefix=s.name)
+        for s in stages
+    ]
+    buffers = [[] for _ in stages]
+    arrived = [0] * len(stages)
+    lock = threading.Lock()
+    finished = threading.Event()
+    remaining = [len(items)]
+    errors = []
+
+    def call_stage(stage: Stage, batch: list) -> list:
+        if cancel is not None and cancel.is_set():
+            raise PipelineCancelled()
+
+        live = [value for _, value in batch if not isinstance(value, _Failed)]
+        if not live:
+            output = []
+        elif stage.batch_size > 1:
+            with metrics.timer("clanki_stage_seconds", stage=stage.name):
+                output = stage.fn(live)
+            if len(output) != len(live):
+                raise ValueError(
+                    f"stage {stage.name} returned {len(output)} items for {len(live)}"
+                )
+        else:
+            with metrics.timer("clanki_stage_seconds", stage=stage.name):
+                output = [stage.fn(live[0])]
+        metrics.inc("clanki_stage_items_total", len(live), stage=stage.name)
+
+        output = iter(output)
+        return [
+            value if isinstance(value, _Failed) else next(output)
+            for _, value in batch
+        ]
+
+    def submit(stage_index: int, batch: list) -> None:
+        future = pools[stage_index].submit(call_stage, stages[stage_index], batch)
+        future.add_done_callback(lambda f: advance(stage_index, batch, f))
+
+    def advance(stage_index: int, batch: list, future) -> None:
+        try:
+            values = future.result()
+        except Exception as e:
+            errors.append(e)
+            values = [_Failed(e)] * len(batch)
+
+        for (index, _), value in zip(batch, values):
+            if on_stage is not None and not isinstance(value, _Failed):
+                try:
+                    on_stage(stages[stage_index].name, index, value)
+                except Exception as e:
+                    errors.append(e)
+            feed(stage_index + 1, index, value)
+
+    def feed(stage_index: int, index: int, value) -> None:
+        if stage_index == len(stages):
+            results[index] = value
+            if on_result is not None and not isinstance(value, _Failed):
+                try:
+                    on_result(index, value)
+                except Exception as e:
+                    errors.append(e)
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+            return
+
+        stage = stages[stage_index]
+        with lock:
+            buffers[stage_index].append((index, value))
+            arrived[stage_index] += 1
+            upstream_done = arrived[stage_index] == len(items)
+            if len(buffers[stage_index]) < stage.batch_size and not upstream_done:
+                return
+            batch = buffers[stage_index]
+            buffers[stage_index] = []
+
+        submit(stage_index, batch)
+
+    for index, item in enumerate(items):
+        feed(0, index, item)
+
+    finished.wait()
+    for pool in pools:
+        pool.shutdown()
+
+    if cancel is not None and cancel.is_set():
+        raise PipelineCancelled()
+
+    if errors:
+        raise errors[0]
+
+    return results
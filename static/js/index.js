@@ -6,9 +6,24 @@ document.addEventListener('DOMContentLoaded', function() {
     const submitBtn = document.getElementById('submit-btn');
     const submitText = document.getElementById('submit-text');
     const loadingSpinner = document.getElementById('loading-spinner');
+    const progressText = document.getElementById('progress-text');
     const errorMessage = document.getElementById('error-message');
     const errorText = document.getElementById('error-text');
     const useAiToggle = document.getElementById('use-ai');
+    const useThumbnailsToggle = document.getElementById('use-thumbnails');
+    const distinctImagesToggle = document.getElementById('distinct-images');
+    const progressPanel = document.getElementById('progress-panel');
+    const stageProgress = document.getElementById('stage-progress');
+    const stopBtn = document.getElementById('stop-btn');
+    const cardList = document.getElementById('card-list');
+
+    const stageLabels = {
+        translate: 'Translated',
+        classify: 'Queries',
+        search: 'Searched',
+        judge: 'Images picked'
+    };
+    let currentJobId = null;
 
     function updateSubmitButton() {
         const hasText = phrasesTextarea.value.trim().length > 0;
@@ -61,6 +76,7 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     function showLoading() {
+        progressText.textContent = 'Processing...';
         submitText.style.display = 'none';
         loadingSpinner.style.display = 'inline-flex';
         errorMessage.style.display = 'none'; // Hide any previous errors
@@ -70,6 +86,7 @@ document.addEventListener('DOMContentLoaded', function() {
         fileUpload.disabled = true;
         clearFileBtn.disabled = true;
         useAiToggle.disabled = true;
+        useThumbnailsToggle.disabled = true;
     }
 
     function hideLoading() {
@@ -78,6 +95,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
         handleInputChange();
         useAiToggle.disabled = false;
+        useThumbnailsToggle.disabled = false;
         clearFileBtn.disabled = false;
     }
 
@@ -126,6 +144,8 @@ document.addEventListener('DOMContentLoaded', function() {
         }
 
         formData.append('use_ai', useAiToggle.checked ? 'on' : 'off');
+        formData.append('use_thumbnails', useThumbnailsToggle.checked ? 'on' : 'off');
+        formData.append('distinct_images', distinctImagesToggle.checked ? 'on' : 'off');
 
         fetch('/create-cards', {
             method: 'POST',
@@ -138,20 +158,136 @@ document.addEventListener('DOMContentLoaded', function() {
                 });
             }
 
+            return response.json();
+        })
+        .then(job => followJob(job.job_id, job.total))
+        .then(jobId => downloadResult(jobId))
+        .catch(error => {
+            showError(error.message || 'An error occurred while processing your request.');
+        });
+    });
+
+    function showProgress(total) {
+        cardList.innerHTML = '';
+        stageProgress.textContent = `0/${total} cards`;
+        stopBtn.disabled = false;
+        progressPanel.style.display = 'block';
+    }
+
+    function renderStages(stageCounts, cardsDone, total) {
+        const parts = Object.keys(stageLabels)
+            .filter(stage => stageCounts[stage])
+            .map(stage => `${stageLabels[stage]} ${stageCounts[stage]}/${total}`);
+        parts.push(`${cardsDone}/${total} cards`);
+        stageProgress.textContent = parts.join(' · ');
+        progressText.textContent = `Processing... ${cardsDone}/${total}`;
+    }
+
+    function addCard(card) {
+        const item = document.createElement('li');
+        item.textContent = `${card[0]} — ${card[1]}`;
+        cardList.appendChild(item);
+        cardList.scrollTop = cardList.scrollHeight;
+    }
+
+    // Streams the job's progress events, resolving once there's a CSV to download
+    function followJob(jobId, total) {
+        currentJobId = jobId;
+        showProgress(total);
+
+        return new Promise((resolve, reject) => {
+            const events = new EventSource(`/jobs/${jobId}/events`);
+            const stageCounts = {};
+            let cardsDone = 0;
+
+            events.addEventListener('status', e => {
+                const job = JSON.parse(e.data);
+                if (job.status === 'done' || job.status === 'cancelled') {
+                    events.close();
+                    resolve(jobId);
+                } else if (job.status === 'failed') {
+                    events.close();
+                    reject(new Error(job.error || 'Generating your cards failed.'));
+                }
+            });
+
+            events.addEventListener('stage', e => {
+                const event = JSON.parse(e.data);
+                stageCounts[event.stage] = (stageCounts[event.stage] || 0) + 1;
+                renderStages(stageCounts, cardsDone, total);
+            });
+
+            events.addEventListener('row', e => {
+                cardsDone += 1;
+                addCard(JSON.parse(e.data).card);
+                renderStages(stageCounts, cardsDone, total);
+            });
+
+            events.addEventListener('done', () => {
+                events.close();
+                resolve(jobId);
+            });
+
+            events.addEventListener('cancelled', () => {
+                events.close();
+                resolve(jobId);
+            });
+
+            events.addEventListener('failed', e => {
+                events.close();
+                reject(new Error(JSON.parse(e.data).error || 'Generating your cards failed.'));
+            });
+
+            events.onerror = () => {
+                if (events.readyState === EventSource.CLOSED) {
+                    reject(new Error('Lost connection to the server.'));
+                }
+            };
+        });
+    }
+
+    function downloadResult(jobId) {
+        return fetch(`/jobs/${jobId}/result`)
+        .then(response => {
+            if (!response.ok) {
+                return response.text().then(text => {
+                    throw new Error(text);
+                });
+            }
+
             return response.blob();
         })
         .then(blob => {
             downloadFile(blob, 'translation_cards.csv');
             hideLoading();
+            currentJobId = null;
+            stopBtn.disabled = true;
 
             phrasesTextarea.value = '';
             fileUpload.value = '';
             fileName.textContent = '';
             clearFileBtn.style.display = 'none';
             handleInputChange();
+        });
+    }
+
+    stopBtn.addEventListener('click', function() {
+        if (!currentJobId) {
+            return;
+        }
+
+        stopBtn.disabled = true;
+        fetch(`/jobs/${currentJobId}/cancel`, { method: 'POST' })
+        .then(response => {
+            if (!response.ok) {
+                return response.text().then(text => {
+                    throw new Error(text);
+                });
+            }
         })
         .catch(error => {
-            showError(error.message || 'An error occurred while processing your request.');
+            stopBtn.disabled = false;
+            showError(error.message || 'Could not stop the job.');
         });
     });
 
@@ -0,0 +1,266 @@
+"""Local stand-in for Brave, image hosts, Google Translate and Claude.
+
+Replays the recorded responses in fixtures/ so the pipeline can be run
+offline, with optional latency and errors injected per route. Claude's
+Message Batches are answered too, each one ended as soon as it's created.
+"""
+
+import html
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+ROUTES = ("brave", "images", "translate", "claude")
+IMAGE_TYPES = {".jpg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+# Images are served from several ports, so per-host fetch limits behave as they
+# would with results spread over many sites
+IMAGE_HOSTS = 5
+
+
+def _load(name: str, mode: str = "r"):
+    with open(os.path.join(FIXTURES_DIR, name), mode) as f:
+        return f.read()
+
+
+class StubState:
+    """Fixtures, injected faults and per-route counters shared by the handlers"""
+
+    def __init__(self, latency: dict = None, error_rate: dict = None, seed: int = 0):
+        self.latency = {route: 0.0 for route in ROUTES} | (latency or {})
+        self.error_rate = {route: 0.0 for route in ROUTES} | (error_rate or {})
+        self.brave = _load("brave_images.json")
+        self.translate_page = _load("translate.html")
+        self.message = json.loads(_load("claude_message.json"))
+        self.images = {
+            name: _load(os.path.join("images", name), "rb")
+            for name in os.listdir(os.path.join(FIXTURES_DIR, "images"))
+        }
+        self.image_hosts = []
+        # Message batches by ID, each ends as soon as it's created
+        self.batches = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {
+            route: {"requests": 0, "errors": 0, "bytes": 0} for route in ROUTES
+        }
+
+    def roll(self, route: str) -> tuple[float, bool]:
+        """Latency to add, exponential around the route's mean, and whether to fail"""
+        with self._lock:
+            mean = self.latency[route]
+            delay = self._random.expovariate(1 / mean) if mean > 0 else 0.0
+            return delay, self._random.random() < self.error_rate[route]
+
+    def count(self, route: str, sent: int, error: bool) -> None:
+        with self._lock:
+            stats = self.stats[route]
+            stats["requests"] += 1
+            stats["bytes"] += sent
+            stats["errors"] += error
+
+    def reset(self) -> None:
+        with self._lock:
+            for stats in self.stats.values():
+                stats.update(requests=0, errors=0, bytes=0)
+
+
+def _claude_reply(request: dict) -> str:
+    content = request["messages"][0]["content"]
+    if isinstance(content, str):
+        # Classification, one query per phrase in the prompt's <text> block
+        phrases = json.loads(content.split("<text>\n")[1].split("</text>")[0])
+        return json.dumps([f"{phrase} photo" for phrase in phrases])
+
+    # Judging, the assistant prefill "[" has already been sent
+    images = sum(1 for block in content if block.get("type") == "image")
+    return ", ".join(str((i * 7) % 10 + 1) for i in range(images)) + "]"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self) -> str:
+        path = urllib.parse.urlsplit(self.path).path
+        return path.strip("/").split("/")[0]
+
+    def _send(self, route: str, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count(route, len(body), status >= 400)
+
+    def _fault(self, route: str) -> bool:
+        delay, fail = self.state.roll(route)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            # Rate limits for the metered APIs, flaky hosts for images
+            status = 503 if route in ("images", "translate") else 429
+            self._send(route, status, b"injected error", "text/plain")
+        return fail
+
+    def do_GET(self):
+        route = self._route()
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        if route not in ROUTES:
+            return self._send("images", 404, b"not found", "text/plain")
+        if self._fault(route):
+            return
+
+        if route == "brave":
+            q = urllib.parse.quote(query.get("q", [""])[0])
+            hosts = self.state.image_hosts or [f"http://{self.headers['Host']}"]
+            body = re.sub(
+                r"\{host:(\d+)\}",
+                lambda m: hosts[int(m.group(1)) % len(hosts)],
+                self.state.brave,
+            ).replace("{query}", q)
+            return self._send(route, 200, body.encode(), "application/json")
+
+        if route == "images":
+            name = parts.path.rsplit("/", 1)[-1]
+            if name not in self.state.images:
+                return self._send(route, 404, b"not found", "text/plain")
+            content_type = IMAGE_TYPES.get(os.path.splitext(name)[1], "image/jpeg")
+            return self._send(route, 200, self.state.images[name], content_type)
+
+        if route == "claude":
+            return self._batch(parts.path)
+
+        # Google Translate's mobile page, each line marked as translated
+        text = query.get("q", [""])[0]
+        translated = "\n".join(f"EN {line}" for line in text.split("\n"))
+        page = self.state.translate_page.replace("{text}", html.escape(translated))
+        page = page.replace("{sl}", query.get("sl", [""])[0])
+        page = page.replace("{tl}", query.get("tl", [""])[0])
+        self._send(route, 200, page.encode(), "text/html; charset=utf-8")
+
+    def do_POST(self):
+        route = self._route()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urllib.parse.urlsplit(self.path).path
+        if route != "claude" or not re.search(r"/v1/messages(/batches)?$", path):
+            return self._send("claude", 404, b"not found", "text/plain")
+        if self._fault(route):
+            return
+
+        request = json.loads(body)
+        if not path.endswith("/batches"):
+            message = json.dumps(self._message(request)).encode()
+            return self._send(route, 200, message, "application/json")
+
+        # The whole batch is answered up front, so it has ended before anyone polls
+        batch_id = f"msgbatch_{uuid.uuid4().hex}"
+        results = [
+            {
+                "custom_id": entry["custom_id"],
+                "result": {
+                    "type": "succeeded",
+                    "message": self._message(entry["params"]),
+                },
+            }
+            for entry in request["requests"]
+        ]
+        batch = {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended",
+            "request_counts": {
+                "processing": 0,
+                "succeeded": len(results),
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": "2024-01-01T00:00:00Z",
+            "ended_at": "2024-01-01T00:00:00Z",
+            "expires_at": "2024-01-02T00:00:00Z",
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"http://{self.headers['Host']}{path}/{batch_id}/results",
+        }
+        with self.state._lock:
+            self.state.batches[batch_id] = (batch, results)
+        self._send(route, 200, json.dumps(batch).encode(), "application/json")
+
+    def _message(self, request: dict) -> dict:
+        reply = _claude_reply(request)
+        return {
+            **self.state.message,
+            "model": request["model"],
+            "content": [{"type": "text", "text": reply}],
+            "usage": {
+                **self.state.message["usage"],
+                # Roughly what the real API would bill, ~4 bytes a token
+                "input_tokens": len(json.dumps(request)) // 4,
+                "output_tokens": len(reply) // 4 + 1,
+            },
+        }
+
+    def _batch(self, path: str) -> None:
+        """Retrieve a batch, or its results as JSON lines"""
+        match = re.search(r"/v1/messages/batches/([^/]+)(/results)?$", path)
+        with self.state._lock:
+            found = self.state.batches.get(match.group(1)) if match else None
+        if found is None:
+            return self._send("claude", 404, b"not found", "text/plain")
+
+        batch, results = found
+        if match.group(2):
+            body = "".join(json.dumps(result) + "\n" for result in results)
+            return self._send("claude", 200, body.encode(), "application/x-jsonl")
+        self._send("claude", 200, json.dumps(batch).encode(), "application/json")
+
+
+def _serve(state: StubState) -> ThreadingHTTPServer:
+    handler = type("Handler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stub_server(state: StubState, image_hosts: int = IMAGE_HOSTS) -> list:
+    """Serve `state` on free localhost ports in background threads.
+
+    Returns the servers, the API server first and then the image hosts.
+    """
+    servers = [_serve(state) for _ in range(1 + image_hosts)]
+    state.image_hosts = [
+        f"http://127.0.0.1:{server.server_address[1]}" for server in servers[1:]
+    ]
+    return servers
+
+
+def stop_stub_server(servers: list) -> None:
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def stub_env(server: ThreadingHTTPServer) -> dict:
+    """Environment that points run.py and web.py at the stub server"""
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    return {
+        "BRAVE_SEARCH_URL": f"{base}/brave/res/v1/images/search",
+        "BRAVE_KEY": "stub",
+        "GOOGLE_TRANSLATE_URL": f"{base}/translate/m",
+        "CLAUDE_BASE_URL": f"{base}/claude",
+        "CLAUDE_KEY": "stub",
+    }
@@ -0,0 +1,138 @@
+"""Offline checks for scheduler.run_pipeline, run with python -m unittest or pytest"""
+
+import random
+import threading
+import time
+import unittest
+
+from scheduler import PipelineCancelled, Stage, run_pipeline
+
+
+def jittered(fn):
+    """Wrap a stage function so calls finish out of order"""
+    rng = random.Random(0)
+    lock = threading.Lock()
+
+    def wrapper(value):
+        with lock:
+            delay = rng.uniform(0, 0.005)
+        time.sleep(delay)
+        return fn(value)
+
+    return wrapper
+
+
+class RunPipelineTest(unittest.TestCase):
+    def test_unbatched_stages_keep_input_order(self):
+        stages = [
+            Stage("double", jittered(lambda x: x * 2), workers=4),
+            Stage("increment", jittered(lambda x: x + 1), workers=3),
+        ]
+        self.assertEqual(
+            run_pipeline(list(range(50)), stages), [x * 2 + 1 for x in range(50)]
+        )
+
+    def test_batched_stages_keep_input_order(self):
+        batches = []
+
+        def square_all(values):
+            batches.append(len(values))
+            return [x * x for x in values]
+
+        stages = [
+            Stage("increment", jittered(lambda x: x + 1), workers=4),
+            Stage("square", jittered(square_all), workers=2, batch_size=7),
+            Stage("negate", jittered(lambda x: -x), workers=3),
+        ]
+        self.assertEqual(
+            run_pipeline(list(range(50)), stages),
+            [-((x + 1) ** 2) for x in range(50)],
+        )
+        self.assertEqual(sum(batches), 50)
+        self.assertTrue(all(size <= 7 for size in batches))
+
+    def test_on_result_sees_every_item_once(self):
+        seen = []
+        lock = threading.Lock()
+
+        def on_result(index, value):
+            with lock:
+                seen.append((index, value))
+
+        stages = [Stage("double", jittered(lambda x: x * 2), workers=4)]
+        run_pipeline(list(range(20)), stages, on_result=on_result)
+        self.assertEqual(sorted(seen), [(x, x * 2) for x in range(20)])
+
+    def test_first_error_is_raised_after_the_other_items_finish(self):
+        finished = []
+
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError("bad item")
+            return x
+
+        stages = [
+            Stage("check", jittered(fail_on_three), workers=4),
+            Stage("collect", lambda x: finished.append(x) or x, workers=2),
+        ]
+        with self.assertRaisesRegex(ValueError, "bad item"):
+            run_pipeline(list(range(10)), stages)
+        self.assertEqual(sorted(finished), [x for x in range(10) if x != 3])
+
+    def test_error_in_a_batched_stage_is_raised(self):
+        def fail_batch(values):
+            if 3 in values:
+                raise RuntimeError("bad batch")
+            return values
+
+        stages = [Stage("check", fail_batch, batch_size=4)]
+        with self.assertRaisesRegex(RuntimeError, "bad batch"):
+            run_pipeline(list(range(10)), stages)
+
+    def test_batched_stage_returning_the_wrong_count_is_an_error(self):
+        stages = [Stage("drop", lambda values: values[1:], batch_size=5)]
+        with self.assertRaisesRegex(ValueError, "returned 4 items for 5"):
+            run_pipeline(list(range(5)), stages)
+
+    def test_cancel_stops_further_stage_work(self):
+        cancel = threading.Event()
+        calls = []
+
+        def record(x):
+            calls.append(x)
+            return x
+
+        def cancel_after_first(name, index, value):
+            cancel.set()
+
+        stages = [
+            Stage("first", record, workers=1),
+            Stage("second", record, workers=1),
+        ]
+        with self.assertRaises(PipelineCancelled):
+            run_pipeline(
+                list(range(20)), stages, on_stage=cancel_after_first, cancel=cancel
+            )
+        self.assertLessEqual(len(calls), 2)
+
+    def test_cancelled_before_starting_runs_nothing(self):
+        cancel = threading.Event()
+        cancel.set()
+        calls = []
+        stages = [Stage("record", lambda x: calls.append(x) or x)]
+        with self.assertRaises(PipelineCancelled):
+            run_pipeline([1, 2, 3], stages, cancel=cancel)
+        self.assertEqual(calls, [])
+
+    def test_empty_input(self):
+        calls = []
+        stages = [
+            Stage("record", lambda x: calls.append(x) or x),
+            Stage("batch", lambda values: calls.extend(values) or values, batch_size=5),
+        ]
+        self.assertEqual(run_pipeline([], stages), [])
+        self.assertEqual(calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
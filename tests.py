@@ -1,7 +1,9 @@
 import os
 import requests
-import certifi
 from dotenv import load_dotenv
+
+from http_client import get_session
+
 load_dotenv()
 print(os.getenv("BRAVE_KEY"))
 
@@ -14,9 +16,8 @@ BRAVE_HEADERS = {
 
 def brave_img_search(phrase: str) -> str:
     try:
-        brave_res = requests.get(
+        brave_res = get_session().get(
             BRAVE_URL,
-            verify=certifi.where(),
             headers=BRAVE_HEADERS,
             params={
                 "q": phrase,
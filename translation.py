@@ -0,0 +1,111 @@
+import os
+from typing import TYPE_CHECKING
+
+from metrics import metrics
+
+# deep_translator pulls in BeautifulSoup, it's only imported once a phrase
+# actually needs translating rather than on every startup
+if TYPE_CHECKING:
+    from deep_translator import GoogleTranslator
+
+# GoogleTranslator refuses payloads of 5000 characters or more
+TRANSLATE_CHAR_LIMIT = 4500
+SEPARATOR = "\n"
+# Points the translator somewhere other than Google, the benchmark uses a stub
+TRANSLATE_URL = os.getenv("GOOGLE_TRANSLATE_URL")
+
+
+def chunk_phrases(phrases: list, char_limit: int = TRANSLATE_CHAR_LIMIT) -> list:
+    """Group phrase indexes so each joined chunk stays under the backend's limit"""
+    chunks = []
+    current = []
+    current_len = 0
+
+    for index, phrase in enumerate(phrases):
+        added_len = len(phrase) + (len(SEPARATOR) if current else 0)
+        if current and current_len + added_len > char_limit:
+            chunks.append(current)
+            current = []
+            current_len = 0
+            added_len = len(phrase)
+
+        current.append(index)
+        current_len += added_len
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def _translate(translator: "GoogleTranslator", text: str) -> str:
+    outcome = "ok"
+    try:
+        with metrics.timer("clanki_provider_seconds", provider="translate"):
+            return translator.translate(text)
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        metrics.inc(
+            "clanki_provider_requests_total", provider="translate", outcome=outcome
+        )
+
+
+def _translate_one(translator: "GoogleTranslator", phrase: str) -> str | None:
+    # The rest of the chunk still gets translated, the caller decides what fails
+    try:
+        return _translate(translator, phrase)
+    except Exception as e:
+        print(f"Couldn't translate '{phrase}'", e)
+        return None
+
+
+def translate_batch(phrases: list, source: str, target: str) -> tuple[list, int]:
+    """Translate many phrases in as few requests as possible.
+
+    Phrases are joined with newlines and sent a chunk at a time. If a chunk
+    fails, or comes back with a different number of lines, its phrases are
+    translated one by one instead, and any that still fail come back as None.
+    Returns the translations in input order and the number of requests made.
+    """
+    from deep_translator import GoogleTranslator
+
+    translator = GoogleTranslator(source=source, target=target)
+    if TRANSLATE_URL:
+        translator._base_url = TRANSLATE_URL
+    translations = [""] * len(phrases)
+    round_trips = 0
+
+    # Empty lines would be dropped by the backend, and multi-line phrases can't be split back
+    batchable = []
+    for index, phrase in enumerate(phrases):
+        if not phrase.strip():
+            continue
+        if SEPARATOR in phrase:
+            translations[index] = _translate_one(translator, phrase)
+            round_trips += 1
+            continue
+        batchable.append(index)
+
+    for chunk in chunk_phrases([phrases[i] for i in batchable]):
+        indexes = [batchable[i] for i in chunk]
+        text = SEPARATOR.join(phrases[i] for i in indexes)
+
+        try:
+            round_trips += 1
+            lines = _translate(translator, text).split(SEPARATOR)
+        except Exception as e:
+            print("Batch translation failed, translating one at a time", e)
+            lines = []
+
+        if len(lines) == len(indexes):
+            for index, line in zip(indexes, lines):
+                translations[index] = line.strip()
+            continue
+
+        for index in indexes:
+            translations[index] = _translate_one(translator, phrases[index])
+            round_trips += 1
+
+    return translations, round_trips
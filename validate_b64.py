@@ -1,28 +1,34 @@
-import base64
 import io
 
-import filetype
-from PIL import Image, UnidentifiedImageError
+from metrics import metrics
 
+# filetype only needs the first 261 bytes to recognise any image format
+SNIFF_BYTES = 261
 
-def detected_mime_from_b64(b64: str) -> str | None:
-    kind = filetype.guess(base64.b64decode(b64, validate=True))
+
+def detected_mime_from_bytes(raw: bytes) -> str | None:
+    import filetype
+
+    kind = filetype.guess(raw[:SNIFF_BYTES])
     return kind.mime if kind else None
 
 
-def is_valid_base64_image(b64: str, mime_type: str) -> bool:
+def is_valid_image(raw: bytes, mime_type: str) -> bool:
+    """Whether `raw` is an undamaged image of `mime_type`, checked from the bytes.
 
-    sniffed_mime_type = detected_mime_from_b64(b64)
+    The MIME type is sniffed from the header and Pillow verifies the rest in
+    the same pass, nothing is decoded or base64 encoded.
+    """
+    from PIL import Image, UnidentifiedImageError
 
-    if sniffed_mime_type is None or sniffed_mime_type != mime_type:
-        return False
+    with metrics.timer("clanki_validate_seconds"):
+        if detected_mime_from_bytes(raw) != mime_type:
+            return False
 
-    if b64.startswith("data:"):
-        b64 = b64.split(",", 1)[1]
-    try:
-        raw = base64.b64decode(b64, validate=True)
-        with Image.open(io.BytesIO(raw)) as im:
-            im.verify()
-        return True
-    except (ValueError, UnidentifiedImageError, OSError):
-        return False
+        try:
+            # BytesIO shares the bytes object's buffer rather than copying it
+            with Image.open(io.BytesIO(raw)) as im:
+                im.verify()
+            return True
+        except (ValueError, UnidentifiedImageError, OSError, SyntaxError):
+            return False
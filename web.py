@@ -1,355 +1,94 @@
-import base64
-import csv
 import io
 import json
-import os
 import pathlib
-import sys
-import time
-import urllib
-from binascii import Error as BinasciiError
-
-import anthropic
-import certifi
-import requests
-from deep_translator import GoogleTranslator
-from dotenv import load_dotenv
-from flask import Flask, make_response, render_template, request, send_file
+import queue
 
-from cli import cli_handle_error
-from llm import LLMClient
-from prompts import image_prompt, phrase_prompt
-from validate_b64 import is_valid_base64_image
+from dotenv import load_dotenv
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    send_file,
+)
+
+from cache import ResultCache
+from config import RunConfig
+from deck_files import CardWriter, format_card, iter_phrases
+from jobs import FINISHED_STATUSES, JobQueue
+from metrics import metrics
+from pipeline import build_deck
 
 load_dotenv()
 
-use_ai = True
-
 app = Flask(__name__)
 
 
-BRAVE_URL = "https://api.search.brave.com/res/v1/images/search"
-BRAVE_HEADERS = {
-    "Accept": "application/json",
-    "Accept-Encoding": "gzip",
-    "X-Subscription-Token": os.getenv("BRAVE_KEY"),
-}
-MIME_TYPES = ["image/jpeg", "image/png", "image/webp"]
-
-PREFILL = "["
-
-
-def get_image_type(image_url) -> str:
-    parsed_url = urllib.parse.urlsplit(image_url)
-    path_split = parsed_url.path.split(".")
-    file_type = path_split[len(path_split) - 1]
-
-    if file_type == "jpg":
-        return "jpeg"
-
-    return file_type
-
-
-def brave_img_search(phrase: str) -> str:
-    try:
-        res = requests.get(
-            BRAVE_URL,
-            verify=certifi.where(),
-            headers=BRAVE_HEADERS,
-            params={
-                "q": phrase,
-                "count": 20,
-                "search_lang": "en-gb",
-                "safesearch": "strict",
-            },
-        )
-        res.raise_for_status()
-        return res.json()
-
-    except requests.exceptions.HTTPError:
-        raise
-
-    except Exception:
-        raise
-
-
-def classify_phrase(phrases: list) -> str:
-    phrase_prompt_data = phrase_prompt.replace("{text}", str(phrases))
-    phrase_prompt_data = phrase_prompt_data.replace("{source_language}", "italian")
-    llm_api = LLMClient()
-    messages = [{"role": "user", "content": phrase_prompt_data}]
-
-    try:
-        message = llm_api.fetch(
-            "claude-sonnet-4-20250514", 1000, "you are a phrase classifier", messages
-        )
-        final_completion_str = message.content[0].text
-        final_completion_list = json.loads(final_completion_str)
-        return final_completion_list
-
-    except anthropic.APIConnectionError as e:
-        print("The server could not be reached", e)
-    except anthropic.RateLimitError:
-        print("A 429 status code was received; we should back off a bit.")
-    except anthropic.APIStatusError as e:
-        print("Another issues occurred: ", e)
-
-
-def search_web_image(phrases: list) -> list:
-    sys.stdout.write(f"Generating images...\n")
-    image_matches = []
-
-    for phrase in phrases:
-        try:
-            data = brave_img_search(phrase)
-        except requests.exceptions.HTTPError as e:
-            if e.response is not None and e.response.status_code == 429:
-                print("hit rate limit, back off", e)
-                time.sleep(1)
-                data = brave_img_search(phrase)
-            else:
-                print(f"HTTPError: {e}")
-                return None
-
-        except Exception as e:
-            print(f"Another error occurred: {e}")
-
-        # If user opts out of AI, Claude isn't called and we rely on Brave's confidence score, images immediately returned
-        if not use_ai:
-            eligible_images = []
-            for i in data.get("results"):
-                img_dict = {"url": "", "file_type": ""}
-
-                if i.get("confidence") == "high":
-                    img_dict["url"] = i.get("properties").get("url")
-                    img_dict["file_type"] = (
-                        get_image_type(i.get("properties").get("url")),
-                    )
-                elif i.get("confidence") == "medium":
-                    img_dict["url"] = i.get("properties").get("url")
-                    img_dict["file_type"] = (
-                        get_image_type(i.get("properties").get("url")),
-                    )
-                else:
-                    img_dict["url"] = i.get("properties").get("url")
-                    img_dict["file_type"] = (
-                        get_image_type(i.get("properties").get("url")),
-                    )
-
-                eligible_images.append(img_dict)
-
-            chosen_image = eligible_images[0]
-            image_matches.append(chosen_image)
-            continue  # break from parent loop
-
-        images = [
-            {
-                "url": i.get("properties").get("url"),
-                "file_type": f"image/{get_image_type(i.get("properties").get("url"))}",
-            }
-            for i in data.get("results")
-        ]
-
-        images_reduced_list = []
-
-        for img in images:
-            try:
-                req = requests.get(img.get("url"))
-                mtype = req.headers.get("Content-Type")
-                if mtype not in MIME_TYPES:
-                    continue
-                images_reduced_list.append(
-                    {"url": img.get("url"), "file_type": img.get("file_type")}
-                )
-            except Exception as e:
-                print("Error fetching or encoding image", e)
-
-        images_base64_list = [
-            {
-                "base_img_data": base64.standard_b64encode(
-                    requests.get(img.get("url")).content
-                ).decode("utf-8"),
-                "file_type": img.get("file_type"),
-            }
-            for img in images_reduced_list
-        ]
-
-        images_base64_list_reduced = [
-            i
-            for i in images_base64_list
-            if is_valid_base64_image(i.get("base_img_data"), i.get("file_type"))
-        ]
-
-        images_prompt_data = [
-            {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": img_data.get("file_type"),
-                    "data": img_data.get("base_img_data"),
-                },
-            }
-            for img_data in images_base64_list_reduced
-        ]
-        updated_image_prompt = image_prompt.replace("{text}", f"<text>{phrase}</text>")
-
-        images_prompt_data.append({"type": "text", "text": updated_image_prompt})
-        messages = [
-            {"role": "user", "content": images_prompt_data},
-            {"role": "assistant", "content": PREFILL},
-        ]
-
-        try:
-            llm_client = LLMClient()
-            message = llm_client.fetch(
-                "claude-sonnet-4-20250514",
-                1024,
-                "You are an image classifier and rater",
-                messages,
-            )
-        except anthropic.APIConnectionError as e:
-            print("The server could not be reached")
-        except anthropic.RateLimitError as e:
-            print("A 429 status code was received; we should back off a bit.")
-        except anthropic.APIStatusError as e:
-            print(e)
-
-        final_completion_str = f"{PREFILL}{message.content[0].text}"
-        final_completion_list = json.loads(final_completion_str)
-        max_score = max(final_completion_list)
-        best_image_index = final_completion_list.index(max_score)
-        best_image_url = images[best_image_index]
-        image_matches.append(best_image_url)
-
-    return image_matches
-
-
-def read_file(input_file: str) -> list:
-    path = pathlib.Path(input_file)
-    extension = path.suffix
-
-    if extension != ".txt" and extension != ".csv":
-        cli_handle_error("File type must of be '.txt' or '.csv'", 1)
-
-    if extension == ".txt":
-        try:
-            with open(input_file, "r", encoding="utf-8") as f:
-                phrases = [line.strip() for line in f]
-                if not phrases:
-                    cli_handle_error(
-                        "Error: no phrases detected in your phrases file", 1
-                    )
-                return phrases
-
-        except FileNotFoundError:
-            cli_handle_error("Error: file not found, check name and try again", 1)
-
-    if extension == ".csv":
-        try:
-            with open(input_file, "r", newline="", encoding="utf-8") as c:
-                phrases = []
-                phrasereader = csv.reader(c, delimiter=",")
-                for row in phrasereader:
-                    if len(row) > 1:
-                        cli_handle_error(
-                            "CSV files should only have one column containing phrases, delete any additional columns",
-                            1,
-                        )
-                    else:
-                        phrases.append(row[0])
-
-                return phrases
-
-        except FileNotFoundError:
-            sys.stderr.write("Error: file not found, check the name and try again")
-            sys.exit(1)
-
-
-def translate_phrases(inputs: list) -> list:
-    sys.stdout.write(f"Translating phrases...\n")
-    translations = []
-    for i in inputs:
-        translated_text = GoogleTranslator(source="it", target="en").translate(i)
-        translations.append(translated_text)
-
-    return translations
-
-
-def generate_output(
-    original_phrases: list,
-    translated_phrases: list,
-    images: list,
-    input_file: str = "phrases",
-) -> str:
-    sys.stdout.write(f"Generating csv...\n")
-    csv_output = []
-    phrase_len = len(original_phrases)
-
-    for i in range(0, phrase_len):
-        phrase_dict = {
-            "front": translated_phrases[i],
-            "back": original_phrases[i],
-            "image": f"""<img src='{images[i].get("url")}'/>""",
-        }
-
-        csv_output.append(phrase_dict)
-
-    output = io.StringIO()
-    cw = csv.writer(output)
-
-    for row in csv_output:
-        cw.writerow([row["front"], row["back"], row["image"]])
-
-    csv_content = output.getvalue()
-    output.close()
-
-    sys.stdout.write(f"CSV generated successfully!\n")
-    return csv_content
+# Shared by every job, settings that differ between runs live in RunConfig
+result_cache = ResultCache()
 
 
 def parse_uploaded_file(file) -> list:
-    filename = file.filename
-    file_extension = pathlib.Path(filename).suffix.lower()
-
+    file_extension = pathlib.Path(file.filename).suffix.lower()
     if file_extension not in [".txt", ".csv"]:
         raise ValueError("File type must be '.txt' or '.csv'")
 
-    file_content = file.read().decode("utf-8")
-    file.seek(0)  # Reset file pointer
+    # Decode the upload line by line rather than reading it into one string
+    lines = io.TextIOWrapper(file.stream, encoding="utf-8", newline="")
+    phrases = list(iter_phrases(lines, file_extension))
+    if not phrases:
+        raise ValueError("Error: no phrases detected in your phrases file")
+    return phrases
 
-    if file_extension == ".txt":
-        phrases = [line.strip() for line in file_content.split("\n") if line.strip()]
-        if not phrases:
-            raise ValueError("Error: no phrases detected in your phrases file")
-        return phrases
-
-    elif file_extension == ".csv":
-        phrases = []
-        csv_reader = csv.reader(io.StringIO(file_content))
-        for row in csv_reader:
-            if len(row) > 1:
-                raise ValueError(
-                    "CSV files should only have one column containing phrases"
-                )
-            elif len(row) == 1:
-                phrases.append(row[0].strip())
-        return phrases
-
-
-def process_phrases(input_phrases: list, use_ai_setting: bool = True) -> str:
-    """Process phrases through the full pipeline and return CSV content"""
-    global use_ai
-    use_ai = use_ai_setting
-
-    translated_phrases = translate_phrases(input_phrases)
-
-    optimised_search_phrases = classify_phrase(input_phrases)
-
-    best_image_matches = search_web_image(optimised_search_phrases)
-
-    csv_content = generate_output(input_phrases, translated_phrases, best_image_matches)
 
-    return csv_content
+def process_phrases(
+    input_phrases: list,
+    config: RunConfig,
+    on_result=None,
+    on_stage=None,
+    cancel=None,
+) -> str:
+    """Process phrases through the full pipeline and return CSV content"""
+    output = io.StringIO()
+    build_deck(
+        input_phrases,
+        config,
+        CardWriter(output),
+        on_result=on_result,
+        on_stage=on_stage,
+        cancel=cancel,
+    )
+    return output.getvalue()
+
+
+def run_job(phrases: list, settings: dict, emit, cancel) -> str:
+    def on_stage(stage: str, index: int, row: dict) -> None:
+        emit({"type": "stage", "stage": stage, "index": index, "phrase": row["phrase"]})
+
+    def on_result(index: int, row: dict) -> None:
+        card = format_card(row["phrase"], row["translation"], row["image"])
+        emit({"type": "row", "index": index, "card": card})
+
+    config = RunConfig(
+        use_ai=settings["use_ai"],
+        use_thumbnails=settings["use_thumbnails"],
+        distinct_images=settings.get("distinct_images", False),
+        cache=result_cache,
+    )
+    return process_phrases(
+        phrases,
+        config,
+        on_result,
+        on_stage,
+        cancel,
+    )
+
+
+job_queue = JobQueue(run_job)
+# Jobs left over from before a restart resume now, not on the first request
+job_queue.start()
 
 
 @app.route("/create-cards", methods=["POST"])
@@ -359,6 +98,8 @@ def create_cards():
         print("Files:", list(request.files.keys()))
 
         use_ai_setting = request.form.get("use_ai") == "on"
+        use_thumbnails_setting = request.form.get("use_thumbnails") == "on"
+        distinct_images_setting = request.form.get("distinct_images") == "on"
 
         phrases_form_data = request.form.get("phrases")
         print("Phrases from form:", repr(phrases_form_data))
@@ -386,24 +127,104 @@ def create_cards():
         if not phrases:
             return "No valid phrases found", 400
 
-        csv_content = process_phrases(phrases, use_ai_setting)
-
-        response = make_response(csv_content)
-        response.headers["Content-Type"] = "text/csv"
-        response.headers["Content-Disposition"] = (
-            "attachment; filename=translation_cards.csv"
+        job_id = job_queue.submit(
+            phrases,
+            {
+                "use_ai": use_ai_setting,
+                "use_thumbnails": use_thumbnails_setting,
+                "distinct_images": distinct_images_setting,
+            },
         )
 
-        return response
+        return jsonify({"job_id": job_id, "total": len(phrases)}), 202
 
     except Exception as e:
         return f"Error processing request: {str(e)}", 500
 
 
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return "Job not found", 404
+
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    # Subscribe before reading the status so no event falls between the two
+    events = job_queue.subscribe(job_id)
+    job = job_queue.get(job_id)
+    if job is None:
+        job_queue.unsubscribe(job_id, events)
+        return "Job not found", 404
+
+    def stream():
+        try:
+            yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            if job["status"] in FINISHED_STATUSES:
+                return
+
+            while True:
+                try:
+                    event = events.get(timeout=15)
+                except queue.Empty:
+                    # The job may be running in another worker, whose events
+                    # never reach this one, so the status is checked directly
+                    latest = job_queue.get(job_id)
+                    if latest is not None and latest["status"] in FINISHED_STATUSES:
+                        yield f"event: status\ndata: {json.dumps(latest)}\n\n"
+                        return
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                if event["type"] in FINISHED_STATUSES:
+                    return
+        finally:
+            job_queue.unsubscribe(job_id, events)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    if not job_queue.cancel(job_id):
+        return "Job isn't running", 409
+
+    return jsonify({"job_id": job_id, "status": "cancelled"})
+
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    csv_content = job_queue.result(job_id)
+    if csv_content is None:
+        return "Job hasn't finished", 409
+
+    response = make_response(csv_content)
+    response.headers["Content-Type"] = "text/csv"
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=translation_cards.csv"
+    )
+
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def home():
     return render_template("home.html")
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)